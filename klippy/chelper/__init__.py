@@ -63,11 +63,20 @@ defs_itersolve = """
 """
 
 defs_trapq = """
+    struct trapq_append_data {
+        double print_time, accel_t, cruise_t, decel_t;
+        double start_pos_x, start_pos_y, start_pos_z;
+        double axes_r_x, axes_r_y, axes_r_z;
+        double start_v, cruise_v, accel;
+    };
+
     void trapq_append(struct trapq *tq, double print_time
         , double accel_t, double cruise_t, double decel_t
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_batch(struct trapq *tq
+        , struct trapq_append_data *data, int count);
     struct trapq *trapq_alloc(void);
     void trapq_free(struct trapq *tq);
     void trapq_free_moves(struct trapq *tq, double print_time);
@@ -149,8 +158,13 @@ defs_serialqueue = """
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
+    void serialqueue_send_many(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *data, int len
+        , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_baud_adjust(struct serialqueue *sq
         , double baud_adjust);
     void serialqueue_set_receive_window(struct serialqueue *sq
@@ -165,6 +179,8 @@ defs_serialqueue = """
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
+    double get_thread_cputime(void);
+    int create_eventfd(void);
 """
 
 defs_std = """
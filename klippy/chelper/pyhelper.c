@@ -9,6 +9,7 @@
 #include <stdint.h> // uint8_t
 #include <stdio.h> // fprintf
 #include <string.h> // strerror
+#include <sys/eventfd.h> // eventfd
 #include <time.h> // struct timespec
 #include "compiler.h" // __visible
 #include "pyhelper.h" // get_monotonic
@@ -26,6 +27,19 @@ get_monotonic(void)
     return (double)ts.tv_sec + (double)ts.tv_nsec * .000000001;
 }
 
+// Return the cpu time consumed by the calling thread
+double __visible
+get_thread_cputime(void)
+{
+    struct timespec ts;
+    int ret = clock_gettime(CLOCK_THREAD_CPUTIME_ID, &ts);
+    if (ret) {
+        report_errno("clock_gettime", ret);
+        return 0.;
+    }
+    return (double)ts.tv_sec + (double)ts.tv_nsec * .000000001;
+}
+
 // Fill a 'struct timespec' with a system time stored in a double
 struct timespec
 fill_time(double time)
@@ -34,6 +48,13 @@ fill_time(double time)
     return (struct timespec) {t, (time - t)*1000000000. };
 }
 
+// Create a non-blocking eventfd for waking the main thread
+int __visible
+create_eventfd(void)
+{
+    return eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+}
+
 static void
 default_logger(const char *msg)
 {
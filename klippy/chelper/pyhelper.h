@@ -2,6 +2,8 @@
 #define PYHELPER_H
 
 double get_monotonic(void);
+double get_thread_cputime(void);
+int create_eventfd(void);
 struct timespec fill_time(double time);
 void set_python_logging_callback(void (*func)(const char *));
 void errorf(const char *fmt, ...) __attribute__ ((format (printf, 1, 2)));
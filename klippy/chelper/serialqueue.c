@@ -22,6 +22,7 @@
 #include <stdlib.h> // malloc
 #include <string.h> // memset
 #include <termios.h> // tcflush
+#include <time.h> // clock_gettime
 #include <unistd.h> // pipe
 #include "compiler.h" // __visible
 #include "list.h" // list_add_tail
@@ -354,6 +355,8 @@ struct serialqueue {
     int input_pos;
     // Threading
     pthread_t tid;
+    clockid_t thread_clock;
+    int has_thread_clock;
     pthread_mutex_t lock; // protects variables below
     pthread_cond_t cond;
     int receive_waiting;
@@ -880,6 +883,15 @@ serialqueue_alloc(int serial_fd, int write_only)
     ret = pthread_create(&sq->tid, NULL, background_thread, sq);
     if (ret)
         goto fail;
+    // The background thread is running - a missing cpu clock only
+    // disables the thread_cpu statistic
+    ret = pthread_getcpuclockid(sq->tid, &sq->thread_clock);
+    if (ret) {
+        report_errno("pthread_getcpuclockid", ret);
+        sq->thread_clock = 0;
+    } else {
+        sq->has_thread_clock = 1;
+    }
 
     return sq;
 
@@ -1003,23 +1015,51 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
+// Schedule the transmission of a series of messages.  The 'data'
+// buffer contains each message prefixed by a single length byte.
 void __visible
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+serialqueue_send_many(struct serialqueue *sq, struct command_queue *cq
+                      , uint8_t *data, int len, uint64_t min_clock
+                      , uint64_t req_clock)
+{
+    struct list_head msgs;
+    list_init(&msgs);
+    uint8_t *p = data, *end = &data[len];
+    while (p < end) {
+        int msglen = *p++;
+        if (msglen > MESSAGE_PAYLOAD_MAX || p + msglen > end) {
+            errorf("Invalid message in send_many");
+            break;
+        }
+        struct queue_message *qm = message_fill(p, msglen);
+        qm->min_clock = min_clock;
+        qm->req_clock = req_clock;
+        list_add_tail(&qm->node, &msgs);
+        p += msglen;
+    }
+    serialqueue_send_batch(sq, cq, &msgs);
+}
+
+// Wait for a message to be available on the receive queue (returns
+// non-zero if the background thread is exiting)
+static int
+wait_receive(struct serialqueue *sq)
 {
-    pthread_mutex_lock(&sq->lock);
-    // Wait for message to be available
     while (list_empty(&sq->receive_queue)) {
         if (pollreactor_is_exit(&sq->pr))
-            goto exit;
+            return -1;
         sq->receive_waiting = 1;
         int ret = pthread_cond_wait(&sq->cond, &sq->lock);
         if (ret)
             report_errno("pthread_cond_wait", ret);
     }
+    return 0;
+}
 
-    // Remove message from queue
+// Remove the first message from the receive queue and copy it to 'pqm'
+static void
+pull_message(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
     struct queue_message *qm = list_first_entry(
         &sq->receive_queue, struct queue_message, node);
     list_del(&qm->node);
@@ -1034,13 +1074,38 @@ serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
         debug_queue_add(&sq->old_receive, qm);
     else
         message_free(qm);
+}
 
+// Return a message read from the serial port (or wait for one if none
+// available)
+void __visible
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    pthread_mutex_lock(&sq->lock);
+    if (wait_receive(sq))
+        pqm->len = -1;
+    else
+        pull_message(sq, pqm);
     pthread_mutex_unlock(&sq->lock);
-    return;
+}
 
-exit:
-    pqm->len = -1;
+// Return up to 'max' messages read from the serial port (or wait for
+// one if none available).  Returns the number of messages copied to
+// 'q' or -1 if the background thread is exiting.
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
+{
+    pthread_mutex_lock(&sq->lock);
+    if (wait_receive(sq)) {
+        pthread_mutex_unlock(&sq->lock);
+        return -1;
+    }
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue))
+        pull_message(sq, &q[count++]);
     pthread_mutex_unlock(&sq->lock);
+    return count;
 }
 
 void __visible
@@ -1081,17 +1146,26 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
     memcpy(&stats, sq, sizeof(stats));
     pthread_mutex_unlock(&sq->lock);
 
-    snprintf(buf, len, "bytes_write=%u bytes_read=%u"
-             " bytes_retransmit=%u bytes_invalid=%u"
-             " send_seq=%u receive_seq=%u retransmit_seq=%u"
-             " srtt=%.3f rttvar=%.3f rto=%.3f"
-             " ready_bytes=%u stalled_bytes=%u"
-             , stats.bytes_write, stats.bytes_read
-             , stats.bytes_retransmit, stats.bytes_invalid
-             , (int)stats.send_seq, (int)stats.receive_seq
-             , (int)stats.retransmit_seq
-             , stats.srtt, stats.rttvar, stats.rto
-             , stats.ready_bytes, stats.stalled_bytes);
+    int pos = snprintf(buf, len, "bytes_write=%u bytes_read=%u"
+                       " bytes_retransmit=%u bytes_invalid=%u"
+                       " send_seq=%u receive_seq=%u retransmit_seq=%u"
+                       " srtt=%.3f rttvar=%.3f rto=%.3f"
+                       " ready_bytes=%u stalled_bytes=%u"
+                       , stats.bytes_write, stats.bytes_read
+                       , stats.bytes_retransmit, stats.bytes_invalid
+                       , (int)stats.send_seq, (int)stats.receive_seq
+                       , (int)stats.retransmit_seq
+                       , stats.srtt, stats.rttvar, stats.rto
+                       , stats.ready_bytes, stats.stalled_bytes);
+
+    // Cpu time used by the background thread
+    if (!stats.has_thread_clock || pos < 0 || pos >= len)
+        return;
+    struct timespec ts;
+    double thread_cpu = 0.;
+    if (!clock_gettime(stats.thread_clock, &ts))
+        thread_cpu = (double)ts.tv_sec + (double)ts.tv_nsec * .000000001;
+    snprintf(&buf[pos], len - pos, " thread_cpu=%.3f", thread_cpu);
 }
 
 // Extract old messages stored in the debug queues
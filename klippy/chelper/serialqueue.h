@@ -57,7 +57,12 @@ void serialqueue_send_batch(struct serialqueue *sq, struct command_queue *cq
 void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len, uint64_t min_clock
                       , uint64_t req_clock, uint64_t notify_id);
+void serialqueue_send_many(struct serialqueue *sq, struct command_queue *cq
+                           , uint8_t *data, int len, uint64_t min_clock
+                           , uint64_t req_clock);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
+int serialqueue_pull_batch(struct serialqueue *sq
+                           , struct pull_queue_message *q, int max);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_receive_window(struct serialqueue *sq, int receive_window);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
@@ -68,6 +68,19 @@ trapq_append(struct trapq *tq, double print_time
     }
 }
 
+// Add a batch of moves to the trapezoid velocity queue
+void __visible
+trapq_append_batch(struct trapq *tq, struct trapq_append_data *data, int count)
+{
+    int i;
+    for (i=0; i<count; i++, data++)
+        trapq_append(tq, data->print_time
+                     , data->accel_t, data->cruise_t, data->decel_t
+                     , data->start_pos_x, data->start_pos_y, data->start_pos_z
+                     , data->axes_r_x, data->axes_r_y, data->axes_r_z
+                     , data->start_v, data->cruise_v, data->accel);
+}
+
 // Return the distance moved given a time in a move
 inline double
 move_get_distance(struct move *m, double move_time)
@@ -24,12 +24,21 @@ struct trapq {
     struct list_head moves;
 };
 
+struct trapq_append_data {
+    double print_time, accel_t, cruise_t, decel_t;
+    double start_pos_x, start_pos_y, start_pos_z;
+    double axes_r_x, axes_r_y, axes_r_z;
+    double start_v, cruise_v, accel;
+};
+
 struct move *move_alloc(void);
 void trapq_append(struct trapq *tq, double print_time
                   , double accel_t, double cruise_t, double decel_t
                   , double start_pos_x, double start_pos_y, double start_pos_z
                   , double axes_r_x, double axes_r_y, double axes_r_z
                   , double start_v, double cruise_v, double accel);
+void trapq_append_batch(struct trapq *tq, struct trapq_append_data *data
+                        , int count);
 double move_get_distance(struct move *m, double move_time);
 struct coord move_get_coord(struct move *m, double move_time);
 struct trapq *trapq_alloc(void);
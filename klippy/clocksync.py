@@ -27,6 +27,7 @@ class ClockSync:
         self.clock_avg = self.clock_covariance = 0.
         self.prediction_variance = 0.
         self.last_prediction_time = 0.
+        self.connect_completion = reactor.completion()
     def connect(self, serial):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
@@ -47,6 +48,7 @@ class ClockSync:
         self.cmd_queue = serial.alloc_command_queue()
         serial.register_response(self._handle_clock, 'clock')
         self.reactor.update_timer(self.get_clock_timer, self.reactor.NOW)
+        self.connect_completion.complete(True)
     def connect_file(self, serial, pace=False):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
@@ -55,6 +57,13 @@ class ClockSync:
         if pace:
             freq = self.mcu_freq
         serial.set_clock_est(freq, self.reactor.monotonic(), 0)
+        self.connect_completion.complete(True)
+    def cancel_connect(self):
+        if not self.connect_completion.test():
+            self.connect_completion.complete(False)
+    def wait_connect(self):
+        # Wait for the clock estimate from a connect() in another greenlet
+        return self.connect_completion.wait()
     # MCU clock querying (_handle_clock is invoked from background thread)
     def _get_clock_event(self, eventtime):
         self.serial.raw_send(self.get_clock_cmd, 0, 0, self.cmd_queue)
@@ -172,6 +181,9 @@ class SecondarySync(ClockSync):
     def connect(self, serial):
         ClockSync.connect(self, serial)
         self.clock_adj = (0., self.mcu_freq)
+        # Calibration requires a synchronized main mcu clock
+        if not self.main_sync.wait_connect():
+            return
         curtime = self.reactor.monotonic()
         main_print_time = self.main_sync.estimated_print_time(curtime)
         local_print_time = self.estimated_print_time(curtime)
@@ -94,6 +94,7 @@ class PrinterConfig:
         self.printer = printer
         self.autosave = None
         self.status_info = {}
+        self.status_version = 0
         self.save_config_pending = False
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
@@ -254,11 +255,14 @@ class PrinterConfig:
         self.printer.set_rollover_info("config", "\n".join(lines))
     # Status reporting
     def _build_status(self, config):
+        self.status_version += 1
         self.status_info.clear()
         for section in config.get_prefix_sections(''):
             self.status_info[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
                 section_status[option] = section.get(option, note_valid=False)
+    def get_status_version(self, eventtime):
+        return (self.status_version, self.save_config_pending)
     def get_status(self, eventtime):
         return {'config': self.status_info,
                 'save_config_pending': self.save_config_pending}
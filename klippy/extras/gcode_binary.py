@@ -0,0 +1,173 @@
+# Compact binary representation of a g-code file
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import struct
+import gcode
+
+# File layout: a header followed by a stream of records.  Each record
+# notes the number of bytes it covers in the original text file so
+# that positions in the original file can be tracked during playback.
+#
+# Move record: type byte (MOVE_G1 flag and X/Y/Z/E/F presence mask),
+#   source length (uint8), and an int32 for each present parameter.
+#   Each parameter is stored as a decimal mantissa (upper 29 bits) and
+#   number of digits after the decimal point (lower 3 bits).
+# Text record: TYPE_TEXT, source length (uint32), text length
+#   (uint32), text (the original line without newline)
+# Skip record: TYPE_SKIP, source length (uint32) - covers comments and
+#   blank lines which are not dispatched
+MAGIC = "KGCB"
+VERSION = 1
+HEADER = struct.Struct("<4sBQ")
+FILE_EXT = "gcbin"
+
+MOVE_G1 = 0x20
+TYPE_TEXT = 0x80
+TYPE_SKIP = 0x81
+MAX_MOVE_SOURCE = 0xff
+
+SOURCE_LEN = struct.Struct("<I")
+TEXT_HEADER = struct.Struct("<II")
+MOVE_STRUCTS = [struct.Struct("<B" + "i" * bin(mask).count('1'))
+                for mask in range(32)]
+AXIS_MASKS = {'X': 0x01, 'Y': 0x02, 'Z': 0x04, 'E': 0x08, 'F': 0x10}
+MAX_DIGITS = 7
+MAX_MANTISSA = 1 << 28
+SCALES = [10.**i for i in range(MAX_DIGITS + 1)]
+
+class error(Exception):
+    pass
+
+
+######################################################################
+# Encoding
+######################################################################
+
+def encode_header(source_size):
+    return HEADER.pack(MAGIC, VERSION, source_size)
+
+# Encode a decimal number (as found in the text) into an int32 (returns
+# None if the value can not be reproduced exactly)
+def encode_value(text):
+    ipart, dot, fpart = text.partition('.')
+    digits = len(fpart)
+    if digits > MAX_DIGITS:
+        return None
+    mantissa = int((ipart + fpart).lstrip('+') or '0')
+    if abs(mantissa) >= MAX_MANTISSA:
+        return None
+    if mantissa / SCALES[digits] != float(text):
+        return None
+    return (mantissa << 3) | digits
+
+# Convert a line of g-code into a record (returns None for lines that
+# should be folded into a skip record)
+def encode_line(line, source_len):
+    m = gcode.GCodeDispatch.fast_move_r.match(line)
+    if m is not None and source_len <= MAX_MOVE_SOURCE:
+        values = {}
+        for word in m.group(2).split():
+            values[word[0]] = word[1:]
+        params = [encode_value(values[a]) for a in 'XYZEF' if a in values]
+        if None not in params and float(values.get('F', 1.)) > 0.:
+            mask = 0
+            for axis in values:
+                mask |= AXIS_MASKS[axis]
+            rtype = mask
+            if m.group(1) == 'G1':
+                rtype |= MOVE_G1
+            return chr(rtype) + MOVE_STRUCTS[mask].pack(source_len, *params)
+    text = line.strip()
+    cpos = text.find(';')
+    if cpos >= 0:
+        text = text[:cpos]
+    if not text.strip():
+        return None
+    return (chr(TYPE_TEXT) + TEXT_HEADER.pack(source_len, len(line))
+            + line)
+
+# Translate a text g-code file into the binary format
+def compile_file(infile, outfile):
+    infile.seek(0, 2)
+    outfile.write(encode_header(infile.tell()))
+    infile.seek(0)
+    skip_len = 0
+    for line in infile:
+        source_len = len(line)
+        if line.endswith('\n'):
+            line = line[:-1]
+        rec = encode_line(line, source_len)
+        if rec is None:
+            skip_len += source_len
+            continue
+        if skip_len:
+            outfile.write(chr(TYPE_SKIP) + SOURCE_LEN.pack(skip_len))
+            skip_len = 0
+        outfile.write(rec)
+    if skip_len:
+        outfile.write(chr(TYPE_SKIP) + SOURCE_LEN.pack(skip_len))
+
+
+######################################################################
+# Decoding
+######################################################################
+
+# Check for (and parse) the header of a binary g-code file
+def read_header(f):
+    data = f.read(HEADER.size)
+    if len(data) < HEADER.size or not data.startswith(MAGIC):
+        return None
+    magic, version, source_size = HEADER.unpack(data)
+    if version != VERSION:
+        raise error("Unsupported binary g-code version %d" % (version,))
+    return source_size
+
+# Decode the records in 'data'.  Returns a list of (source_len,
+# record_len, cmd, params) tuples and the number of bytes consumed.
+# For moves 'cmd' is G0/G1 and 'params' is a list of X, Y, Z, E, F
+# values (or None); for text records 'cmd' is None and 'params' is the
+# text line; for skip records both are None.
+def decode_records(data):
+    records = []
+    pos = 0
+    datalen = len(data)
+    while pos < datalen:
+        rtype = ord(data[pos])
+        if rtype < TYPE_TEXT:
+            st = MOVE_STRUCTS[rtype & 0x1f]
+            end = pos + 1 + st.size
+            if end > datalen:
+                break
+            values = st.unpack_from(data, pos + 1)
+            params = [None, None, None, None, None]
+            i = 1
+            for axis in range(5):
+                if rtype & (1 << axis):
+                    v = values[i]
+                    params[axis] = (v >> 3) / SCALES[v & 0x07]
+                    i += 1
+            cmd = 'G0'
+            if rtype & MOVE_G1:
+                cmd = 'G1'
+            records.append((values[0], end - pos, cmd, params))
+        elif rtype == TYPE_TEXT:
+            if pos + 1 + TEXT_HEADER.size > datalen:
+                break
+            source_len, text_len = TEXT_HEADER.unpack_from(data, pos + 1)
+            start = pos + 1 + TEXT_HEADER.size
+            end = start + text_len
+            if end > datalen:
+                break
+            records.append((source_len, end - pos, None, data[start:end]))
+        elif rtype == TYPE_SKIP:
+            end = pos + 1 + SOURCE_LEN.size
+            if end > datalen:
+                break
+            source_len, = SOURCE_LEN.unpack_from(data, pos + 1)
+            records.append((source_len, end - pos, None, None))
+        else:
+            raise error("Invalid binary g-code record type %d" % (rtype,))
+        pos = end
+    return records, pos
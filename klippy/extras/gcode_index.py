@@ -0,0 +1,356 @@
+# Layer and progress index for g-code files
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, math, struct, bisect, gzip, logging, multiprocessing
+import gcode, gcode_binary
+
+# The index is stored in a hidden "sidecar" file next to the g-code
+# file.  All positions are byte offsets in the original g-code text
+# (which may differ from the file offset of a .gcbin file).
+#
+# Header: magic, version, file size and mtime (to detect stale
+#   indexes), g-code text size, line count, checkpoint count, layer
+#   count, total estimated time, total filament
+# Checkpoint (every CHECKPOINT_LINES lines or records): position,
+#   estimated time
+# Layer: position, file offset, z height, estimated time and filament
+#   used at the start of the layer
+MAGIC = "KGIX"
+VERSION = 1
+HEADER = struct.Struct("<4sBQdQQIIdd")
+CHECKPOINT = struct.Struct("<Qd")
+LAYER = struct.Struct("<QQddd")
+CHECKPOINT_LINES = 1000
+DEFAULT_VELOCITY = 300.
+DEFAULT_ACCEL = 3000.
+DEFAULT_SQUARE_CORNER_VELOCITY = 5.
+
+def get_index_filename(fname):
+    dname, bname = os.path.split(fname)
+    return os.path.join(dname, ".%s.index" % (bname,))
+
+
+######################################################################
+# Index building
+######################################################################
+
+# Track the toolhead position and estimate the time of each move
+class MoveEstimator:
+    def __init__(self, max_velocity, max_accel, square_corner_velocity):
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        scv2 = square_corner_velocity**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / max_accel
+        self.pos = [0., 0., 0., 0.]
+        self.speed = 25.
+        self.absolute_coord = self.absolute_extrude = True
+        self.print_time = self.filament = 0.
+        # The last move is only timed once its end speed is known - it
+        # is stored as (move_d, axes_r, start_v2, cruise_v2)
+        self.prev_move = None
+    def _calc_move_time(self, move_d, start_v2, cruise_v2, end_v2):
+        # Time of a trapezoid move (same math as toolhead.Move)
+        accel = self.max_accel
+        peak_v2 = (start_v2 + end_v2 + 2. * move_d * accel) * .5
+        if peak_v2 < max(start_v2, end_v2):
+            # Speed change not possible in the move - use average speed
+            return 2. * move_d / (math.sqrt(start_v2) + math.sqrt(end_v2))
+        cruise_v2 = min(cruise_v2, peak_v2)
+        half_inv_accel = .5 / accel
+        accel_d = (cruise_v2 - start_v2) * half_inv_accel
+        decel_d = (cruise_v2 - end_v2) * half_inv_accel
+        cruise_d = move_d - accel_d - decel_d
+        start_v, cruise_v = math.sqrt(start_v2), math.sqrt(cruise_v2)
+        end_v = math.sqrt(end_v2)
+        return (accel_d / ((start_v + cruise_v) * 0.5) + cruise_d / cruise_v
+                + decel_d / ((end_v + cruise_v) * 0.5))
+    def _calc_junction(self, move_d, axes_r, cruise_v2):
+        # Find the maximum speed squared at the junction between the
+        # previous move and the new move (as done in toolhead.Move)
+        prev_move_d, prev_axes_r, prev_start_v2, prev_cruise_v2 = (
+            self.prev_move)
+        if axes_r is None or prev_axes_r is None:
+            return 0.
+        junction_cos_theta = -(axes_r[0] * prev_axes_r[0]
+                               + axes_r[1] * prev_axes_r[1]
+                               + axes_r[2] * prev_axes_r[2])
+        if junction_cos_theta > 0.999999:
+            return 0.
+        junction_cos_theta = max(junction_cos_theta, -0.999999)
+        sin_theta_d2 = math.sqrt(0.5*(1.0-junction_cos_theta))
+        R = self.junction_deviation * sin_theta_d2 / (1. - sin_theta_d2)
+        tan_theta_d2 = sin_theta_d2 / math.sqrt(0.5*(1.0+junction_cos_theta))
+        # Approximated circle must contact moves no further away than mid-move
+        centripetal_r = .5 * min(move_d, prev_move_d) * tan_theta_d2
+        return min(R * self.max_accel, centripetal_r * self.max_accel,
+                   cruise_v2, prev_cruise_v2,
+                   prev_start_v2 + 2. * prev_move_d * self.max_accel)
+    def _add_move(self, move_d, axes_r, cruise_v2):
+        # Time the previous move now that its end speed is known
+        start_v2 = 0.
+        if self.prev_move is not None:
+            start_v2 = self._calc_junction(move_d, axes_r, cruise_v2)
+            prev_move_d, prev_axes_r, prev_start_v2, prev_cruise_v2 = (
+                self.prev_move)
+            self.print_time += self._calc_move_time(
+                prev_move_d, prev_start_v2, prev_cruise_v2, start_v2)
+        self.prev_move = (move_d, axes_r, start_v2, cruise_v2)
+    def flush(self):
+        # Time the final move (which ends at a stop)
+        if self.prev_move is not None:
+            move_d, axes_r, start_v2, cruise_v2 = self.prev_move
+            self.print_time += self._calc_move_time(
+                move_d, start_v2, cruise_v2, 0.)
+            self.prev_move = None
+    def move(self, params):
+        # params is a list of X, Y, Z, E, F values (or None)
+        if params[4] is not None:
+            self.speed = min(params[4] / 60., self.max_velocity)
+        pos = self.pos
+        newpos = list(pos)
+        for i in range(3):
+            v = params[i]
+            if v is not None:
+                newpos[i] = v if self.absolute_coord else pos[i] + v
+        v = params[3]
+        if v is not None:
+            if self.absolute_coord and self.absolute_extrude:
+                newpos[3] = v
+            else:
+                newpos[3] = pos[3] + v
+        dx, dy, dz = newpos[0]-pos[0], newpos[1]-pos[1], newpos[2]-pos[2]
+        de = newpos[3] - pos[3]
+        move_d = math.sqrt(dx*dx + dy*dy + dz*dz)
+        if move_d < .000000001:
+            # Extrude only move (starts and ends at a stop)
+            move_d = abs(de)
+            axes_r = None
+        else:
+            inv_move_d = 1. / move_d
+            axes_r = (dx * inv_move_d, dy * inv_move_d, dz * inv_move_d)
+        if move_d and self.speed > 0.:
+            self._add_move(move_d, axes_r, self.speed**2)
+        self.filament += de
+        self.pos = newpos
+        return dz, de
+    def command(self, line):
+        # Handle commands that alter position tracking (returns the
+        # move parameters for G0/G1 commands)
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        parts = line.upper().split()
+        if not parts:
+            return None
+        cmd = parts[0]
+        if cmd in ('G0', 'G1'):
+            params = [None, None, None, None, None]
+            for p in parts[1:]:
+                axis = 'XYZEF'.find(p[:1])
+                if axis >= 0:
+                    try:
+                        params[axis] = float(p[1:])
+                    except ValueError:
+                        pass
+            return params
+        elif cmd == 'G90':
+            self.absolute_coord = True
+        elif cmd == 'G91':
+            self.absolute_coord = False
+        elif cmd == 'M82':
+            self.absolute_extrude = True
+        elif cmd == 'M83':
+            self.absolute_extrude = False
+        elif cmd == 'G92':
+            for p in parts[1:]:
+                axis = 'XYZE'.find(p[:1])
+                if axis >= 0:
+                    try:
+                        self.pos[axis] = float(p[1:])
+                    except ValueError:
+                        pass
+        return None
+
+def _parse_move(line):
+    m = gcode.GCodeDispatch.fast_move_r.match(line)
+    if m is None:
+        return None
+    params = [None, None, None, None, None]
+    for word in m.group(2).split():
+        params['XYZEF'.index(word[0])] = float(word[1:])
+    return params
+
+# Generate (source_len, record_len, cmd, params) tuples for a file
+def _read_text_records(f):
+    for line in f:
+        params = _parse_move(line)
+        if params is not None:
+            yield len(line), len(line), 'G1', params
+        else:
+            yield len(line), len(line), None, line
+
+def _read_binary_records(f):
+    data = ""
+    while 1:
+        newdata = f.read(65536)
+        if not newdata:
+            return
+        data += newdata
+        records, count = gcode_binary.decode_records(data)
+        data = data[count:]
+        for rec in records:
+            yield rec
+
+def build_index(fname, max_velocity=DEFAULT_VELOCITY,
+                max_accel=DEFAULT_ACCEL,
+                square_corner_velocity=DEFAULT_SQUARE_CORNER_VELOCITY):
+    st = os.stat(fname)
+    if fname.endswith('.gz'):
+        f = gzip.open(fname, 'rb')
+    else:
+        f = open(fname, 'rb')
+    source_size = gcode_binary.read_header(f)
+    if source_size is None:
+        f.seek(0)
+        offset = 0
+        records = _read_text_records(f)
+    else:
+        offset = gcode_binary.HEADER.size
+        records = _read_binary_records(f)
+    est = MoveEstimator(max_velocity, max_accel, square_corner_velocity)
+    checkpoints = []
+    layers = []
+    layer_z = None
+    zchange = None
+    pos = line_count = 0
+    for source_len, rec_len, cmd, params in records:
+        if cmd is None and params is not None:
+            params = est.command(params)
+        if params is not None:
+            filament = est.filament
+            dz, de = est.move(params)
+            start = (pos, offset, est.print_time, filament)
+            if de > 0.:
+                if layer_z is None or (zchange is not None
+                                       and est.pos[2] > layer_z):
+                    # First extrusion after a change to a new height
+                    layer_z = est.pos[2]
+                    lpos, loffset, ltime, lfilament = zchange or start
+                    layers.append((lpos, loffset, layer_z, ltime, lfilament))
+                zchange = None
+            elif dz and zchange is None:
+                # Possible start of a new layer (a layer is only started
+                # by a non-extruding Z move so that a spiral "vase" does
+                # not start a layer on each move)
+                zchange = start
+        if not line_count % CHECKPOINT_LINES:
+            checkpoints.append((pos, est.print_time))
+        pos += source_len
+        offset += rec_len
+        line_count += 1
+    f.close()
+    est.flush()
+    if source_size is None:
+        source_size = pos
+    # Write the index (using a rename so that it is never seen partially)
+    index_fname = get_index_filename(fname)
+    tmp_fname = index_fname + ".tmp"
+    f = open(tmp_fname, 'wb')
+    f.write(HEADER.pack(MAGIC, VERSION, st.st_size, st.st_mtime,
+                        source_size, line_count, len(checkpoints), len(layers),
+                        est.print_time, est.filament))
+    f.write("".join([CHECKPOINT.pack(*c) for c in checkpoints]))
+    f.write("".join([LAYER.pack(*l) for l in layers]))
+    f.close()
+    os.rename(tmp_fname, index_fname)
+
+# Build an index in a low priority background process
+def start_background_build(fname, max_velocity, max_accel,
+                           square_corner_velocity):
+    def wrapper():
+        import queuelogger
+        queuelogger.clear_bg_logging()
+        try:
+            os.nice(10)
+            build_index(fname, max_velocity, max_accel,
+                        square_corner_velocity)
+        except:
+            logging.exception("Unable to build index for %s", fname)
+    proc = multiprocessing.Process(target=wrapper)
+    proc.daemon = True
+    proc.start()
+    return proc
+
+
+######################################################################
+# Index lookup
+######################################################################
+
+class GCodeIndex:
+    def __init__(self, data):
+        (magic, version, file_size, file_mtime, self.source_size,
+         self.line_count, checkpoint_count, layer_count, self.total_time,
+         self.total_filament) = HEADER.unpack_from(data)
+        pos = HEADER.size
+        self.checkpoint_pos = []
+        self.checkpoint_time = []
+        for i in range(checkpoint_count):
+            cpos, ctime = CHECKPOINT.unpack_from(data, pos)
+            self.checkpoint_pos.append(cpos)
+            self.checkpoint_time.append(ctime)
+            pos += CHECKPOINT.size
+        self.layers = []
+        for i in range(layer_count):
+            self.layers.append(LAYER.unpack_from(data, pos))
+            pos += LAYER.size
+        self.layer_pos = [l[0] for l in self.layers]
+    def get_estimated_time(self, position):
+        # Interpolate between the checkpoints surrounding position
+        idx = bisect.bisect_right(self.checkpoint_pos, position) - 1
+        if idx < 0:
+            return 0.
+        start_pos, start_time = (self.checkpoint_pos[idx],
+                                 self.checkpoint_time[idx])
+        if idx + 1 < len(self.checkpoint_pos):
+            end_pos = self.checkpoint_pos[idx + 1]
+            end_time = self.checkpoint_time[idx + 1]
+        else:
+            end_pos, end_time = self.source_size, self.total_time
+        if end_pos <= start_pos:
+            return start_time
+        frac = min(1., float(position - start_pos) / (end_pos - start_pos))
+        return start_time + frac * (end_time - start_time)
+    def get_progress(self, position):
+        if self.total_time <= 0.:
+            return float(position) / max(self.source_size, 1)
+        return min(1., self.get_estimated_time(position) / self.total_time)
+    def get_layer(self, position):
+        # Return the number of the layer at position (starting from 1)
+        return bisect.bisect_right(self.layer_pos, position)
+    def get_layer_info(self, layer):
+        # Return (position, file offset, z, time, filament) for a layer
+        return self.layers[layer - 1]
+
+# Load the index for a file (returns None if missing or out of date)
+def load_index(fname):
+    index_fname = get_index_filename(fname)
+    try:
+        st = os.stat(fname)
+        f = open(index_fname, 'rb')
+        data = f.read()
+        f.close()
+    except (IOError, OSError):
+        return None
+    if len(data) < HEADER.size or not data.startswith(MAGIC):
+        return None
+    magic, version, file_size, file_mtime = HEADER.unpack_from(data)[:4]
+    if (version != VERSION or file_size != st.st_size
+        or file_mtime != st.st_mtime):
+        return None
+    try:
+        return GCodeIndex(data)
+    except struct.error:
+        logging.exception("Invalid g-code index %s", index_fname)
+        return None
@@ -32,6 +32,8 @@ class GCodeMove:
             desc = getattr(self, 'cmd_' + cmd + '_help', None)
             gcode.register_command(cmd, func, False, desc)
         gcode.register_command('G0', self.cmd_G1)
+        gcode.register_fast_move('G0', self._process_move)
+        gcode.register_fast_move('G1', self._process_move)
         gcode.register_command('M114', self.cmd_M114, True)
         gcode.register_command('GET_POSITION', self.cmd_GET_POSITION, True)
         # G-Code coordinate manipulation
@@ -105,33 +107,41 @@ class GCodeMove:
     def cmd_G1(self, gcmd):
         # Move
         params = gcmd.get_command_parameters()
+        coords = [None, None, None, None, None]
         try:
-            for pos, axis in enumerate('XYZ'):
+            for pos, axis in enumerate('XYZEF'):
                 if axis in params:
-                    v = float(params[axis])
-                    if not self.absolute_coord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v
-                    else:
-                        # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                if not self.absolute_coord or not self.absolute_extrude:
-                    # value relative to position of last move
-                    self.last_position[3] += v
-                else:
-                    # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
-            if 'F' in params:
-                gcode_speed = float(params['F'])
-                if gcode_speed <= 0.:
-                    raise gcmd.error("Invalid speed in '%s'"
-                                     % (gcmd.get_commandline(),))
-                self.speed = gcode_speed * self.speed_factor
+                    coords[pos] = float(params[axis])
         except ValueError as e:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
+        self._process_move(gcmd.get_commandline(), coords)
+    def _process_move(self, commandline, coords):
+        # Perform a move from a list of X, Y, Z, E, F values (or None)
+        for pos in range(3):
+            v = coords[pos]
+            if v is not None:
+                if not self.absolute_coord:
+                    # value relative to position of last move
+                    self.last_position[pos] += v
+                else:
+                    # value relative to base coordinate position
+                    self.last_position[pos] = v + self.base_position[pos]
+        v = coords[3]
+        if v is not None:
+            v *= self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                # value relative to position of last move
+                self.last_position[3] += v
+            else:
+                # value relative to base coordinate position
+                self.last_position[3] = v + self.base_position[3]
+        gcode_speed = coords[4]
+        if gcode_speed is not None:
+            if gcode_speed <= 0.:
+                raise self.printer.command_error("Invalid speed in '%s'"
+                                                 % (commandline,))
+            self.speed = gcode_speed * self.speed_factor
         self.move_with_transform(self.last_position, self.speed)
     def cmd_G28(self, gcmd):
         # Move to origin
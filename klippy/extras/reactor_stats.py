@@ -0,0 +1,25 @@
+# Report reactor timer lateness and callback duration statistics
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+class ReactorStats:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        reactor = self.printer.get_reactor()
+        self.latency_stats = reactor.enable_latency_stats()
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor_stats/histograms",
+                                   self._handle_histograms)
+    def _handle_histograms(self, web_request):
+        web_request.send(self.latency_stats.get_histograms())
+    def stats(self, eventtime):
+        lateness, duration, owner = self.latency_stats.get_recent_max()
+        return False, "reactor_late=%.6f reactor_cb=%.6f cb_owner=%s" % (
+            lateness, duration, owner), {
+                'reactor_late': lateness, 'reactor_cb': duration,
+                'cb_owner': owner}
+
+def load_config(config):
+    return ReactorStats(config)
@@ -3,11 +3,13 @@
 # Copyright (C) 2018-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, time, logging
+import os, time, logging, collections, json
 
 def get_os_stats(eventtime):
     # Get core usage stats
-    msg = "sysload=%.2f cputime=%.3f" % (os.getloadavg()[0], time.clock())
+    sysload, cputime = os.getloadavg()[0], time.clock()
+    msg = "sysload=%.2f cputime=%.3f" % (sysload, cputime)
+    fields = {'sysload': sysload, 'cputime': cputime}
     # Get available system memory
     try:
         f = open("/proc/meminfo", "rb")
@@ -15,31 +17,106 @@ def get_os_stats(eventtime):
         f.close()
         for line in data.split('\n'):
             if line.startswith("MemAvailable:"):
-                msg = "%s memavail=%s" % (msg, line.split()[1])
+                memavail = int(line.split()[1])
+                msg = "%s memavail=%d" % (msg, memavail)
+                fields['memavail'] = memavail
                 break
     except:
         pass
-    return (False, msg)
+    return (False, msg, fields)
+
+def get_gc_stats(reactor):
+    gen_stats, deferred = reactor.get_gc_pause_stats()
+    fields = {'gc_pause': sum([s[1] for s in gen_stats]),
+              'gc_max': max([s[2] for s in gen_stats]),
+              'gc_deferred': deferred}
+    return (False, "gc_pause=%.3f gc_max=%.6f gc_deferred=%d" % (
+        fields['gc_pause'], fields['gc_max'], deferred), fields)
+
+# Add the fields of a "name: key=val key=val" stats message to a dict
+def parse_stats(msg, out):
+    section = out
+    for part in msg.split():
+        if '=' not in part:
+            if part.endswith(':'):
+                section = out.setdefault(part[:-1], {})
+            continue
+        name, val = part.split('=', 1)
+        try:
+            val = int(val)
+        except ValueError:
+            try:
+                val = float(val)
+            except ValueError:
+                pass
+        section[name] = val
+    return out
+
+# Add the fields from a stats callback to a dict.  A callback may
+# return (is_active, msg) or (is_active, msg, fields) where fields is a
+# dict of the values in msg (with "name:" sections as nested dicts).
+def add_stats(stats, out):
+    if len(stats) < 3:
+        return parse_stats(stats[1], out)
+    for name, val in stats[2].items():
+        if isinstance(val, dict):
+            out.setdefault(name, {}).update(val)
+        else:
+            out[name] = val
+    return out
 
 class PrinterStats:
     def __init__(self, config):
         self.printer = config.get_printer()
-        reactor = self.printer.get_reactor()
+        self.reactor = reactor = self.printer.get_reactor()
         self.stats_timer = reactor.register_timer(self.generate_stats)
         self.stats_cb = []
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self.handle_disconnect)
+        # Recent statistics (one entry per logged "Stats" line)
+        history = config.getint('history', 300, minval=0)
+        self.history = collections.deque(maxlen=history)
+        self.output = None
+        output = config.get('output', None)
+        if output is not None:
+            try:
+                self.output = open(os.path.expanduser(output), 'ab', 1)
+            except IOError as e:
+                raise config.error("Unable to open statistics output: %s"
+                                   % (str(e),))
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("statistics/history",
+                                   self._handle_history)
     def handle_ready(self):
         self.stats_cb = [o.stats for n, o in self.printer.lookup_objects()
                          if hasattr(o, 'stats')]
         if self.printer.get_start_args().get('debugoutput') is None:
             reactor = self.printer.get_reactor()
             reactor.update_timer(self.stats_timer, reactor.NOW)
+    def handle_disconnect(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+    def _handle_history(self, web_request):
+        since = web_request.get_float('since', 0.)
+        web_request.send({'samples': [s for s in self.history
+                                      if s['#sampletime'] > since]})
     def generate_stats(self, eventtime):
         stats = [cb(eventtime) for cb in self.stats_cb]
         if max([s[0] for s in stats]):
+            stats.append(get_gc_stats(self.reactor))
             stats.append(get_os_stats(eventtime))
             logging.info("Stats %.1f: %s", eventtime,
                          ' '.join([s[1] for s in stats]))
+            if self.history.maxlen or self.output is not None:
+                sample = {'#sampletime': eventtime}
+                for s in stats:
+                    add_stats(s, sample)
+                self.history.append(sample)
+                if self.output is not None:
+                    self.output.write(json.dumps(
+                        sample, separators=(',', ':')) + '\n')
         return eventtime + 1.
 
 def load_config(config):
@@ -3,25 +3,241 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, logging, mmap, threading, zlib, Queue as queue
+import gcode_binary, gcode_index
 
-VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
+VALID_GCODE_EXTS = ['gcode', 'g', 'gco', gcode_binary.FILE_EXT]
+GZIP_EXT = 'gz'
+READ_SIZE = 8192
+READ_LINES = 256
+READ_AHEAD_CHUNK = 65536
+GZIP_READ_CHUNK = 16384
+GZIP_QUEUE_CHUNKS = 16
+GZIP_CHECKPOINT_INTERVAL = 4 * 1024 * 1024
+
+# Memory mapped file with a background thread that reads ahead of the
+# current position (so that slow storage does not stall the reactor)
+class ReadAheadFile:
+    def __init__(self, f, offset, window):
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.mm)
+        self.pos = self.ready_pos = self.min_ready_pos = min(offset,
+                                                            self.size)
+        self.window = window
+        self.bytes_read = 0
+        self.fd = os.dup(f.fileno())
+        self.stop_thread = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead_thread)
+        self.thread.daemon = True
+        self.thread.start()
+    def _read_ahead_thread(self):
+        # Read the file (using a regular read so that the GIL is not
+        # held while waiting) to bring it into the page cache
+        while not self.stop_thread:
+            target = min(max(self.pos + self.window, self.min_ready_pos),
+                         self.size)
+            if self.ready_pos >= target:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            try:
+                os.lseek(self.fd, self.ready_pos, os.SEEK_SET)
+                data = os.read(self.fd, min(READ_AHEAD_CHUNK,
+                                            target - self.ready_pos))
+            except os.error:
+                logging.exception("virtual_sdcard read ahead")
+                break
+            if not data:
+                logging.error("virtual_sdcard file truncated")
+                break
+            self.bytes_read += len(data)
+            self.ready_pos += len(data)
+    def _check_thread(self):
+        if not self.thread.is_alive():
+            raise IOError("virtual_sdcard read ahead failed")
+    def read(self, size):
+        # Return data already read by the background thread (None if
+        # the thread has not yet caught up)
+        if self.pos >= self.size:
+            return ""
+        end = min(self.pos + size, self.ready_pos)
+        if end <= self.pos:
+            self._check_thread()
+            return None
+        data = self.mm[self.pos:end]
+        self.pos = end
+        self.wake.set()
+        return data
+    def read_lines(self, count):
+        # Return up to 'count' lines (taken directly from the mapping)
+        # that the background thread has read.  Returns an empty list
+        # at the end of the file and None if the thread is behind.
+        # Each line is a string slice - the g-code parser requires a
+        # str, and a buffer() view plus a later str() conversion is
+        # slower than a single slice.
+        find = self.mm.find
+        mm = self.mm
+        pos = self.pos
+        ready_pos = self.ready_pos
+        lines = []
+        for i in range(count):
+            nl = find('\n', pos, ready_pos)
+            if nl < 0:
+                break
+            lines.append(mm[pos:nl])
+            pos = nl + 1
+        if not lines:
+            if ready_pos >= self.size:
+                # A final line without a newline is not run
+                return []
+            self._check_thread()
+            # Make sure a line longer than the window is read in full
+            self.min_ready_pos = ready_pos + READ_AHEAD_CHUNK
+            self.wake.set()
+            return None
+        self.pos = pos
+        self.wake.set()
+        return lines
+    def close(self):
+        self.stop_thread = True
+        self.wake.set()
+        self.thread.join()
+        os.close(self.fd)
+        self.mm.close()
+
+# Background thread that decompresses a gzip file.  Decompressed data
+# is passed to the main thread through a bounded queue.  Checkpoints
+# of the decompressor state are stored periodically so that a later
+# read from a given (uncompressed) position does not need to
+# decompress the file from the start.  A checkpoint is only taken once
+# a whole compressed chunk is consumed, so checkpoints remain valid in
+# files with several gzip members.
+class GzipReader:
+    def __init__(self, f, offset, checkpoints):
+        self.start_pos = offset
+        self.checkpoints = checkpoints
+        self.bytes_read = 0
+        # Compressed file position of the last block returned by read()
+        self.in_pos = 0
+        self.fd = os.dup(f.fileno())
+        self.queue = queue.Queue(GZIP_QUEUE_CHUNKS)
+        self.stop_thread = False
+        self.thread = threading.Thread(target=self._decompress_thread)
+        self.thread.daemon = True
+        self.thread.start()
+    def _put(self, data):
+        while not self.stop_thread:
+            try:
+                self.queue.put(data, timeout=0.100)
+                return
+            except queue.Full:
+                pass
+    def _decompress_thread(self):
+        try:
+            self._decompress()
+        except:
+            logging.exception("virtual_sdcard decompress")
+    def _decompress(self):
+        # Start from the last checkpoint before the requested position
+        out_pos = in_pos = 0
+        decomp = None
+        for cp_out_pos, cp_in_pos, cp_decomp in reversed(self.checkpoints):
+            if cp_out_pos <= self.start_pos:
+                out_pos, in_pos, decomp = cp_out_pos, cp_in_pos, cp_decomp
+                break
+        if decomp is None:
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decomp = decomp.copy()
+        os.lseek(self.fd, in_pos, os.SEEK_SET)
+        while not self.stop_thread:
+            cdata = os.read(self.fd, GZIP_READ_CHUNK)
+            self.bytes_read += len(cdata)
+            in_pos += len(cdata)
+            is_eof = not cdata
+            while not self.stop_thread:
+                if is_eof:
+                    data = decomp.flush()
+                else:
+                    # Limit the size of each decompressed block
+                    data = decomp.decompress(cdata, READ_AHEAD_CHUNK)
+                    cdata = decomp.unconsumed_tail
+                    if not cdata and decomp.unused_data:
+                        # A gzip file may contain several members (eg,
+                        # from pigz or concatenated files)
+                        cdata = decomp.unused_data
+                        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                prev_pos = out_pos
+                out_pos += len(data)
+                if prev_pos < self.start_pos:
+                    data = data[self.start_pos - prev_pos:]
+                if data:
+                    self._put((data, in_pos))
+                if not cdata:
+                    break
+            if self.stop_thread:
+                return
+            if is_eof:
+                self._put(("", in_pos))
+                return
+            last_cp_pos = 0
+            if self.checkpoints:
+                last_cp_pos = self.checkpoints[-1][0]
+            if out_pos >= last_cp_pos + GZIP_CHECKPOINT_INTERVAL:
+                self.checkpoints.append((out_pos, in_pos, decomp.copy()))
+    def read(self, size):
+        # Return the next block of decompressed data (None if the
+        # thread has not yet caught up)
+        try:
+            data, self.in_pos = self.queue.get_nowait()
+        except queue.Empty:
+            if not self.thread.is_alive():
+                raise IOError("virtual_sdcard decompress failed")
+            return None
+        return data
+    def close(self):
+        self.stop_thread = True
+        self.thread.join()
+        os.close(self.fd)
 
 class VirtualSD:
     def __init__(self, config):
-        printer = config.get_printer()
+        self.printer = printer = config.get_printer()
         printer.register_event_handler("klippy:shutdown", self.handle_shutdown)
+        if printer.get_start_args().get('debuginput') is not None:
+            printer.register_event_handler("gcode:debug_input_eof",
+                                           self.handle_debug_input_eof)
         # sdcard state
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        # Offset of the next line (or record) in the current file
+        self.file_offset = 0
+        self.is_binary = self.is_compressed = False
+        self.gzip_checkpoints = []
+        # Size of a compressed file and the fraction of it that is read
+        self.gzip_size = 0
+        self.gzip_progress = 0.
         # Print Stat Tracking
         self.print_stats = printer.load_object(config, 'print_stats')
         # Work timer
         self.reactor = printer.get_reactor()
         self.must_pause_work = self.cmd_from_sd = False
         self.work_timer = None
+        # Number of lines (and max time) to dispatch per gcode mutex hold
+        self.batch_lines = config.getint('dispatch_batch_lines', 1, minval=1)
+        self.batch_time = config.getfloat('dispatch_batch_time', 0.050,
+                                          above=0.)
+        # File reading
+        self.readahead_size = config.getint('readahead_size', 0, minval=0)
+        self.reader = None
+        self.read_bytes = 0
+        self.read_wait = 0.
+        # Layer and progress index
+        self.build_index = config.getboolean('build_index', False)
+        self.index = self.index_proc = None
+        self.index_fname = self.index_build_fname = None
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         for cmd in ['M20', 'M21', 'M23', 'M24', 'M25', 'M26', 'M27']:
@@ -34,9 +250,20 @@ class VirtualSD:
         self.gcode.register_command(
             "SDCARD_PRINT_FILE", self.cmd_SDCARD_PRINT_FILE,
             desc=self.cmd_SDCARD_PRINT_FILE_help)
+        self.gcode.register_command(
+            "SDCARD_SEEK_LAYER", self.cmd_SDCARD_SEEK_LAYER,
+            desc=self.cmd_SDCARD_SEEK_LAYER_help)
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
+            if self.is_binary:
+                logging.info("Virtual sdcard binary file (%d): offset %d",
+                             self.file_position, self.file_offset)
+                return
+            if self.is_compressed:
+                logging.info("Virtual sdcard compressed file (%d)",
+                             self.file_position)
+                return
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
@@ -48,18 +275,34 @@ class VirtualSD:
             logging.info("Virtual sdcard (%d): %s\nUpcoming (%d): %s",
                          readpos, repr(data[:readcount]),
                          self.file_position, repr(data[readcount:]))
+    def handle_debug_input_eof(self):
+        # In batch mode, complete an active print before exiting
+        while self.work_timer is not None and not self.must_pause_work:
+            self.reactor.pause(self.reactor.monotonic() + .100)
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
+        read_bytes = self.read_bytes
+        if self.reader is not None:
+            read_bytes += self.reader.bytes_read
+        return True, "sd_pos=%d sd_read=%d sd_read_wait=%.3f" % (
+            self.file_position, read_bytes, self.read_wait), {
+                'sd_pos': self.file_position, 'sd_read': read_bytes,
+                'sd_read_wait': self.read_wait}
     def get_file_list(self, check_subdirs=False):
         if check_subdirs:
             flist = []
             for root, dirs, files in os.walk(
                     self.sdcard_dirname, followlinks=True):
                 for name in files:
-                    ext = name[name.rfind('.')+1:]
-                    if ext not in VALID_GCODE_EXTS:
+                    base = name
+                    is_compressed = base.endswith('.' + GZIP_EXT)
+                    if is_compressed:
+                        base = base[:-len(GZIP_EXT)-1]
+                    ext = base[base.rfind('.')+1:]
+                    if ext not in VALID_GCODE_EXTS or (
+                            is_compressed and ext == gcode_binary.FILE_EXT):
+                        # Compressed binary files are not supported
                         continue
                     full_path = os.path.join(root, name)
                     r_path = full_path[len(self.sdcard_dirname) + 1:]
@@ -77,13 +320,50 @@ class VirtualSD:
             except:
                 logging.exception("virtual_sdcard get_file_list")
                 raise self.gcode.error("Unable to get file list")
+    def _load_index(self, fname, eventtime):
+        self.index_fname = fname
+        self.index = gcode_index.load_index(fname)
+        if self.index is not None or not self.build_index:
+            return
+        if self.index_proc is not None and self.index_proc.is_alive():
+            # Only one index is built at a time
+            return
+        toolhead = self.printer.lookup_object('toolhead')
+        status = toolhead.get_status(eventtime)
+        logging.info("virtual_sdcard building index for %s", fname)
+        self.index_build_fname = fname
+        self.index_proc = gcode_index.start_background_build(
+            fname, status['max_velocity'], status['max_accel'],
+            status['square_corner_velocity'])
+    def _check_index(self):
+        # Load the index once a background build completes
+        if self.index_proc is None or self.index_proc.is_alive():
+            return
+        self.index_proc.join()
+        self.index_proc = None
+        if self.index is None and self.index_build_fname == self.index_fname:
+            self.index = gcode_index.load_index(self.index_fname)
+            self._update_compressed_size()
+    def _update_compressed_size(self):
+        # The uncompressed size of a gzip file is only known from its index
+        if self.is_compressed and self.index is not None:
+            self.file_size = self.index.source_size
     def get_status(self, eventtime):
+        self._check_index()
         progress = 0.
-        if self.file_size:
+        layer = layer_count = 0
+        if self.index is not None:
+            progress = self.index.get_progress(self.file_position)
+            layer = self.index.get_layer(self.file_position)
+            layer_count = len(self.index.layers)
+        elif self.is_compressed:
+            progress = self.gzip_progress
+        elif self.file_size:
             progress = float(self.file_position) / self.file_size
         is_active = self.is_active()
         return {'progress': progress, 'is_active': is_active,
-                'file_position': self.file_position}
+                'file_position': self.file_position,
+                'layer': layer, 'layer_count': layer_count}
     def is_active(self):
         return self.work_timer is not None
     def do_pause(self):
@@ -100,6 +380,12 @@ class VirtualSD:
             self.current_file.close()
             self.current_file = None
         self.file_position = self.file_size = 0.
+        self.file_offset = 0
+        self.is_binary = self.is_compressed = False
+        self.gzip_checkpoints = []
+        self.gzip_size = 0
+        self.gzip_progress = 0.
+        self.index = self.index_fname = None
         self.print_stats.reset()
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
         "if necessary"
@@ -119,6 +405,31 @@ class VirtualSD:
             filename = filename[1:]
         self._load_file(gcmd, filename, check_subdirs=True)
         self.cmd_M24(gcmd)
+    cmd_SDCARD_SEEK_LAYER_help = "Set the SD position to the start of a layer"
+    def cmd_SDCARD_SEEK_LAYER(self, gcmd):
+        if self.work_timer is not None:
+            raise gcmd.error("SD busy")
+        if self.current_file is None:
+            raise gcmd.error("No SD file loaded")
+        self._check_index()
+        proc = self.index_proc
+        if (self.index is None and proc is not None
+            and self.index_build_fname == self.index_fname):
+            # Wait for the index of the selected file to be built
+            gcmd.respond_info("Waiting for SD file index")
+            while proc.is_alive():
+                self.reactor.pause(self.reactor.monotonic() + .100)
+            self._check_index()
+        if self.index is None:
+            raise gcmd.error("No index available for SD file")
+        if not self.index.layers:
+            raise gcmd.error("No layers found in SD file")
+        layer = gcmd.get_int('LAYER', minval=1, maxval=len(self.index.layers))
+        pos, offset, z, est_time, filament = self.index.get_layer_info(layer)
+        self.file_position = pos
+        self.file_offset = offset
+        gcmd.respond_info("SD position set to layer %d (z=%.3f position %d)"
+                          % (layer, z, pos))
     def cmd_M20(self, gcmd):
         # List SD card
         files = self.get_file_list()
@@ -151,17 +462,48 @@ class VirtualSD:
             fname = files_by_lower[filename.lower()]
             fname = os.path.join(self.sdcard_dirname, fname)
             f = open(fname, 'rb')
+            is_compressed = fname.endswith('.' + GZIP_EXT)
+            source_size = None
+            if is_compressed:
+                # Check the start of the decompressed data for a binary
+                # g-code header
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data = decomp.decompress(f.read(GZIP_READ_CHUNK),
+                                         gcode_binary.HEADER.size)
+                is_compressed_binary = data.startswith(gcode_binary.MAGIC)
+            else:
+                source_size = gcode_binary.read_header(f)
             f.seek(0, os.SEEK_END)
             fsize = f.tell()
             f.seek(0)
         except:
             logging.exception("virtual_sdcard file open")
             raise gcmd.error("Unable to open file")
-        gcmd.respond_raw("File opened:%s Size:%d" % (filename, fsize))
-        gcmd.respond_raw("File selected")
+        if is_compressed and is_compressed_binary:
+            f.close()
+            raise gcmd.error("Compressed binary g-code files are not supported")
+        self.is_compressed = is_compressed
+        self.gzip_checkpoints = []
+        self.gzip_progress = 0.
+        self.is_binary = source_size is not None
+        self.file_offset = 0
+        if self.is_binary:
+            # Report positions using the original g-code file
+            fsize = source_size
+            self.file_offset = gcode_binary.HEADER.size
         self.current_file = f
         self.file_position = 0
         self.file_size = fsize
+        self._load_index(fname, self.reactor.monotonic())
+        if is_compressed:
+            # The uncompressed size is not known until the file is indexed
+            # (the gzip trailer only stores it modulo 2^32, and only for
+            # the last member of the file)
+            self.gzip_size = fsize
+            self.file_size = 0
+            self._update_compressed_size()
+        gcmd.respond_raw("File opened:%s Size:%d" % (filename, self.file_size))
+        gcmd.respond_raw("File selected")
         self.print_stats.set_current_file(filename)
     def cmd_M24(self, gcmd):
         # Start/resume SD print
@@ -179,6 +521,7 @@ class VirtualSD:
             raise gcmd.error("SD busy")
         pos = gcmd.get_int('S', minval=0)
         self.file_position = pos
+        self.file_offset = None
     def cmd_M27(self, gcmd):
         # Report SD print status
         if self.current_file is None:
@@ -187,11 +530,112 @@ class VirtualSD:
         gcmd.respond_raw("SD printing byte %d/%d"
                          % (self.file_position, self.file_size))
     # Background work timer
+    def _dispatch_lines(self, lines, gcode_mutex):
+        # Run commands (while holding the gcode mutex) until the batch
+        # limits are reached or another task is waiting on the mutex
+        end_time = self.reactor.monotonic() + self.batch_time
+        for i in range(self.batch_lines):
+            source_len, rec_len, cmd, params = lines[-1]
+            try:
+                if cmd is not None:
+                    self.gcode.run_fast_move(cmd, params)
+                elif params is not None:
+                    self.gcode.run_script_from_command(params)
+            except self.gcode.error as e:
+                self.print_stats.note_error(str(e))
+                return True
+            except:
+                logging.exception("virtual_sdcard dispatch")
+                return True
+            lines.pop()
+            self.file_position += source_len
+            self.file_offset += rec_len
+            if (not lines or self.must_pause_work
+                or gcode_mutex.has_waiters()
+                or self.reactor.monotonic() >= end_time):
+                break
+        return False
+    def _find_binary_offset(self, position):
+        # Find the first record of a binary file at or after 'position'
+        f = self.current_file
+        offset = gcode_binary.HEADER.size
+        f.seek(offset)
+        source_pos = 0
+        data = ""
+        while source_pos < position:
+            newdata = f.read(65536)
+            if not newdata:
+                break
+            data += newdata
+            records, count = gcode_binary.decode_records(data)
+            data = data[count:]
+            for source_len, rec_len, cmd, params in records:
+                if source_pos >= position:
+                    break
+                source_pos += source_len
+                offset += rec_len
+        return offset, source_pos
+    def _read_lines(self, data, partial_input):
+        # Convert file data into a list of (source_len, record_len, cmd,
+        # params) records along with any remaining partial input
+        if self.is_binary:
+            data = partial_input + data
+            lines, count = gcode_binary.decode_records(data)
+            return lines, data[count:]
+        lines = data.split('\n')
+        lines[0] = partial_input + lines[0]
+        partial_input = lines.pop()
+        return [(len(l) + 1, len(l) + 1, None, l) for l in lines], partial_input
+    def _read_records(self, partial_input):
+        # Read the next set of records from the file (returns None at
+        # the end of the file)
+        start_time = self.reactor.monotonic()
+        if self.reader is None:
+            data = self.current_file.read(READ_SIZE)
+            self.read_bytes += len(data)
+            self.read_wait += self.reactor.monotonic() - start_time
+            if not data:
+                return None
+            return self._read_lines(data, partial_input)
+        line_reader = not self.is_binary and not self.is_compressed
+        while 1:
+            if line_reader:
+                data = self.reader.read_lines(READ_LINES)
+            else:
+                data = self.reader.read(READ_SIZE)
+            if data is not None:
+                break
+            # Wait for the read ahead thread
+            self.reactor.pause(self.reactor.monotonic() + 0.005)
+        self.read_wait += self.reactor.monotonic() - start_time
+        if self.is_compressed:
+            self.gzip_progress = (float(self.reader.in_pos)
+                                  / max(self.gzip_size, 1))
+        if not data:
+            return None
+        if line_reader:
+            return [(len(l) + 1, len(l) + 1, None, l) for l in data], ""
+        return self._read_lines(data, partial_input)
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
         try:
-            self.current_file.seek(self.file_position)
+            if self.file_offset is None:
+                # Position was changed by M26
+                if self.is_binary:
+                    self.file_offset, self.file_position = (
+                        self._find_binary_offset(self.file_position))
+                else:
+                    self.file_offset = self.file_position
+            self.current_file.seek(self.file_offset)
+            fsize = os.fstat(self.current_file.fileno()).st_size
+            if self.is_compressed:
+                self.reader = GzipReader(self.current_file, self.file_offset,
+                                         self.gzip_checkpoints)
+            elif self.readahead_size and fsize:
+                self.reader = ReadAheadFile(self.current_file,
+                                            self.file_offset,
+                                            self.readahead_size)
         except:
             logging.exception("virtual_sdcard seek")
             self.work_timer = None
@@ -204,20 +648,22 @@ class VirtualSD:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    res = self._read_records(partial_input)
+                except gcode_binary.error as e:
+                    logging.exception("virtual_sdcard binary file")
+                    self.print_stats.note_error(str(e))
+                    break
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if res is None:
                     # End of file
                     self.current_file.close()
                     self.current_file = None
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
+                lines, partial_input = res
                 lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
@@ -225,18 +671,17 @@ class VirtualSD:
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch commands
             self.cmd_from_sd = True
-            try:
-                self.gcode.run_script(lines[-1])
-            except self.gcode.error as e:
-                self.print_stats.note_error(str(e))
-                break
-            except:
-                logging.exception("virtual_sdcard dispatch")
+            with gcode_mutex:
+                error = self._dispatch_lines(lines, gcode_mutex)
+            if error:
                 break
             self.cmd_from_sd = False
-            self.file_position += len(lines.pop()) + 1
+        if self.reader is not None:
+            self.read_bytes += self.reader.bytes_read
+            self.reader.close()
+            self.reader = None
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
@@ -6,6 +6,8 @@
 import os, re, logging, collections, shlex
 import homing
 
+EXTENDED_CACHE_SIZE = 256
+
 class GCodeCommand:
     error = homing.CommandError
     def __init__(self, gcode, command, commandline, params, need_ack):
@@ -66,6 +68,18 @@ class GCodeCommand:
         return self.get(name, default, parser=float, minval=minval,
                         maxval=maxval, above=above, below=below)
 
+# Command line of a pre-parsed move (only formatted if it is used, for
+# example in an error message)
+class FastMoveCommandline(object):
+    __slots__ = ['cmd', 'coords']
+    def __init__(self, cmd, coords):
+        self.cmd = cmd
+        self.coords = coords
+    def __str__(self):
+        params = ["%s%r" % (axis, v)
+                  for axis, v in zip('XYZEF', self.coords) if v is not None]
+        return " ".join([self.cmd] + params)
+
 # Parse and dispatch G-Code commands
 class GCodeDispatch:
     error = homing.CommandError
@@ -84,6 +98,10 @@ class GCodeDispatch:
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
         self.gcode_help = {}
+        self.fast_move_handlers = {}
+        # Cache of recently parsed extended command parameters
+        self.extended_cache = collections.OrderedDict()
+        self.extended_cache_hits = self.extended_cache_misses = 0
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115',
                     'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
@@ -100,6 +118,7 @@ class GCodeDispatch:
         except:
             return False
     def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        self.fast_move_handlers.pop(cmd, None)
         if func is None:
             old_cmd = self.ready_gcode_handlers.get(cmd)
             if cmd in self.ready_gcode_handlers:
@@ -133,6 +152,13 @@ class GCodeDispatch:
                 "mux command %s %s %s already registered (%s)" % (
                     cmd, key, value, prev_values))
         prev_values[value] = func
+    def register_fast_move(self, cmd, func):
+        # Register a handler for plain G0/G1 style moves.  The handler is
+        # invoked with the command line (a string, or an object that
+        # formats as one) and a list of X, Y, Z, E, F values (None if
+        # not specified).  It is only used until the
+        # command is next registered (for example, by a gcode_macro).
+        self.fast_move_handlers[cmd] = func
     def get_command_help(self):
         return dict(self.gcode_help)
     def register_output_handler(self, cb):
@@ -151,30 +177,51 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    fast_move_r = re.compile(
+        r'^\s*(G[01])((?:\s+[XYZEF][-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))+)\s*$')
+    fast_move_axes = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3, 'F': 4}
     def _process_commands(self, commands, need_ack=True):
+        fast_move_r = self.fast_move_r
         for line in commands:
-            # Ignore comments and leading/trailing spaces
-            line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            numparts = len(parts)
-            cmd = ""
-            if numparts >= 3 and parts[1] != 'N':
-                cmd = parts[1] + parts[2].strip()
-            elif numparts >= 5 and parts[1] == 'N':
-                # Skip line number at start of command
-                cmd = parts[3] + parts[4].strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, numparts, 2) }
-            gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+            # Check for a plain G0/G1 move (the common case)
+            m = fast_move_r.match(line)
+            fast_move = None
+            if m is not None and self.is_printer_ready:
+                cmd = m.group(1)
+                fast_move = self.fast_move_handlers.get(cmd)
+            if fast_move is not None:
+                origline = line.strip()
+                coords = [None, None, None, None, None]
+                axes = self.fast_move_axes
+                for word in m.group(2).split():
+                    coords[axes[word[0]]] = float(word[1:])
+                gcmd = None
+            else:
+                # Ignore comments and leading/trailing spaces
+                line = origline = line.strip()
+                cpos = line.find(';')
+                if cpos >= 0:
+                    line = line[:cpos]
+                # Break line into parts and determine command
+                parts = self.args_r.split(line.upper())
+                numparts = len(parts)
+                cmd = ""
+                if numparts >= 3 and parts[1] != 'N':
+                    cmd = parts[1] + parts[2].strip()
+                elif numparts >= 5 and parts[1] == 'N':
+                    # Skip line number at start of command
+                    cmd = parts[3] + parts[4].strip()
+                # Build gcode "params" dictionary
+                params = { parts[i]: parts[i+1].strip()
+                           for i in range(1, numparts, 2) }
+                gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
             # Invoke handler for command
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
-                handler(gcmd)
+                if gcmd is None:
+                    fast_move(origline, coords)
+                else:
+                    handler(gcmd)
             except self.error as e:
                 self._respond_error(str(e))
                 self.printer.send_event("gcode:command_error")
@@ -187,9 +234,32 @@ class GCodeDispatch:
                 self._respond_error(msg)
                 if not need_ack:
                     raise
-            gcmd.ack()
+            if gcmd is None:
+                if need_ack:
+                    self.respond_raw("ok")
+            else:
+                gcmd.ack()
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
+    def run_fast_move(self, cmd, coords):
+        # Run a pre-parsed G0/G1 move (see register_fast_move())
+        commandline = FastMoveCommandline(cmd, coords)
+        fast_move = self.fast_move_handlers.get(cmd)
+        if fast_move is None or not self.is_printer_ready:
+            self.run_script_from_command(str(commandline))
+            return
+        try:
+            fast_move(commandline, coords)
+        except self.error as e:
+            self._respond_error(str(e))
+            self.printer.send_event("gcode:command_error")
+            raise
+        except:
+            msg = 'Internal error on command:"%s"' % (commandline,)
+            logging.exception(msg)
+            self.printer.invoke_shutdown(msg)
+            self._respond_error(msg)
+            raise
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
@@ -216,27 +286,45 @@ class GCodeDispatch:
             self.printer.request_exit('error_exit')
     def _respond_state(self, state):
         self.respond_info("Klipper state: %s" % (state,), log=False)
+    def stats(self, eventtime):
+        return False, "extcache_hits=%d extcache_misses=%d" % (
+            self.extended_cache_hits, self.extended_cache_misses), {
+                'extcache_hits': self.extended_cache_hits,
+                'extcache_misses': self.extended_cache_misses}
     # Parameter parsing helpers
     extended_r = re.compile(
         r'^\s*(?:N[0-9]+\s*)?'
         r'(?P<cmd>[a-zA-Z_][a-zA-Z0-9_]+)(?:\s+|$)'
         r'(?P<args>[^#*;]*?)'
         r'\s*(?:[#*;].*)?$')
+    def _split_extended_args(self, eargs):
+        # Arguments without quotes or escapes can be split directly
+        if '"' not in eargs and "'" not in eargs and '\\' not in eargs:
+            return eargs.split()
+        return shlex.split(eargs)
     def _get_extended_params(self, gcmd):
-        m = self.extended_r.match(gcmd.get_commandline())
-        if m is None:
-            raise self.error("Malformed command '%s'"
-                             % (gcmd.get_commandline(),))
-        eargs = m.group('args')
-        try:
-            eparams = [earg.split('=', 1) for earg in shlex.split(eargs)]
-            eparams = { k.upper(): v for k, v in eparams }
-            gcmd._params.clear()
-            gcmd._params.update(eparams)
-            return gcmd
-        except ValueError as e:
-            raise self.error("Malformed command '%s'"
-                             % (gcmd.get_commandline(),))
+        commandline = gcmd.get_commandline()
+        eparams = self.extended_cache.pop(commandline, None)
+        if eparams is not None:
+            self.extended_cache_hits += 1
+        else:
+            self.extended_cache_misses += 1
+            m = self.extended_r.match(commandline)
+            if m is None:
+                raise self.error("Malformed command '%s'" % (commandline,))
+            eargs = m.group('args')
+            try:
+                eparams = [earg.split('=', 1)
+                           for earg in self._split_extended_args(eargs)]
+                eparams = { k.upper(): v for k, v in eparams }
+            except ValueError as e:
+                raise self.error("Malformed command '%s'" % (commandline,))
+            if len(self.extended_cache) >= EXTENDED_CACHE_SIZE:
+                self.extended_cache.popitem(last=False)
+        self.extended_cache[commandline] = eparams
+        gcmd._params.clear()
+        gcmd._params.update(eparams)
+        return gcmd
     # G-Code special command handlers
     def cmd_default(self, gcmd):
         cmd = gcmd.get_command()
@@ -389,6 +477,7 @@ class GCodeIO:
             if not self.is_processing_data:
                 self.reactor.unregister_fd(self.fd_handle)
                 self.fd_handle = None
+                self.printer.send_event("gcode:debug_input_eof")
                 self.gcode.request_restart('exit')
             pending_commands.append("")
         # Handle case where multiple commands pending
@@ -423,7 +512,8 @@ class GCodeIO:
                 logging.exception("Write g-code response")
                 self.pipe_is_active = False
     def stats(self, eventtime):
-        return False, "gcodein=%d" % (self.bytes_read,)
+        return False, "gcodein=%d" % (self.bytes_read,), {
+            'gcodein': self.bytes_read}
 
 def add_early_printer_objects(printer):
     printer.add_object('gcode', GCodeDispatch(printer))
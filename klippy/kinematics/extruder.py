@@ -49,7 +49,9 @@ class PrinterExtruder:
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
         self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
         self.trapq_free_moves = ffi_lib.trapq_free_moves
+        self.ffi_main = ffi_main
         self.sk_extruder = ffi_main.gc(ffi_lib.extruder_stepper_alloc(),
                                        ffi_lib.free)
         self.stepper.set_stepper_kinematics(self.sk_extruder)
@@ -136,20 +138,24 @@ class PrinterExtruder:
         if diff_r:
             return (self.instant_corner_v / abs(diff_r))**2
         return move.max_cruise_v2
-    def move(self, print_time, move):
-        axis_r = move.axes_r[3]
-        accel = move.accel * axis_r
-        start_v = move.start_v * axis_r
-        cruise_v = move.cruise_v * axis_r
-        pressure_advance = 0.
-        if axis_r > 0. and (move.axes_d[0] or move.axes_d[1]):
-            pressure_advance = self.pressure_advance
+    def queue_moves(self, moves):
         # Queue movement (x is extruder movement, y is pressure advance)
-        self.trapq_append(self.trapq, print_time,
-                          move.accel_t, move.cruise_t, move.decel_t,
-                          move.start_pos[3], 0., 0.,
-                          1., pressure_advance, 0.,
-                          start_v, cruise_v, accel)
+        trapq_data = []
+        for print_time, move in moves:
+            axis_r = move.axes_r[3]
+            pressure_advance = 0.
+            if axis_r > 0. and (move.axes_d[0] or move.axes_d[1]):
+                pressure_advance = self.pressure_advance
+            trapq_data.extend((
+                print_time, move.accel_t, move.cruise_t, move.decel_t,
+                move.start_pos[3], 0., 0.,
+                1., pressure_advance, 0.,
+                move.start_v * axis_r, move.cruise_v * axis_r,
+                move.accel * axis_r))
+        data = self.ffi_main.new("double[]", trapq_data)
+        self.trapq_append_batch(
+            self.trapq, self.ffi_main.cast("struct trapq_append_data *", data),
+            len(moves))
     def cmd_M104(self, gcmd, wait=False):
         # Set Extruder Temperature
         temp = gcmd.get_float('S', 0.)
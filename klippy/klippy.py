@@ -224,8 +224,9 @@ class Printer:
                 cb()
             except:
                 logging.exception("Exception during shutdown handler")
-        logging.info("Reactor garbage collection: %s",
-                     self.reactor.get_gc_stats())
+        logging.info("Reactor garbage collection: %s %s",
+                     self.reactor.get_gc_stats(),
+                     self.reactor.get_gc_pause_stats())
     def invoke_async_shutdown(self, msg):
         self.reactor.register_async_callback(
             (lambda e: self.invoke_shutdown(msg)))
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, zlib, logging, math
-import serialhdl, pins, chelper, clocksync
+import serialhdl, msgproto, pins, chelper, clocksync
 
 class error(Exception):
     pass
@@ -401,8 +401,6 @@ class MCU:
         if self._name.startswith('mcu '):
             self._name = self._name[4:]
         self._printer.register_event_handler("klippy:connect", self._connect)
-        self._printer.register_event_handler("klippy:mcu_identify",
-                                             self._mcu_identify)
         self._printer.register_event_handler("klippy:shutdown", self._shutdown)
         self._printer.register_event_handler("klippy:disconnect",
                                              self._disconnect)
@@ -417,8 +415,13 @@ class MCU:
         if not (self._serialport.startswith("/dev/rpmsg_")
                 or self._serialport.startswith("/tmp/klipper_host_")):
             baud = config.getint('baud', 250000, minval=2400)
+        dict_cache = None
+        cache_dir = config.get('dictionary_cache', None)
+        if cache_dir:
+            dict_cache = serialhdl.DictionaryCache(
+                os.path.expanduser(cache_dir))
         self._serial = serialhdl.SerialReader(
-            self._reactor, self._serialport, baud, serial_rts)
+            self._reactor, self._serialport, baud, serial_rts, dict_cache)
         # Restarts
         self._restart_method = 'command'
         if baud:
@@ -450,6 +453,7 @@ class MCU:
         self._mcu_tick_avg = 0.
         self._mcu_tick_stddev = 0.
         self._mcu_tick_awake = 0.
+        self._startup_times = []
     # Serial callbacks
     def _handle_mcu_stats(self, params):
         count = params['count']
@@ -532,14 +536,11 @@ class MCU:
         if prev_crc is None:
             logging.info("Sending MCU '%s' printer configuration...",
                          self._name)
-            for c in self._config_cmds:
-                self._serial.send(c)
+            self._serial.send_many(self._config_cmds)
         else:
-            for c in self._restart_cmds:
-                self._serial.send(c)
+            self._serial.send_many(self._restart_cmds)
         # Transmit init messages
-        for c in self._init_cmds:
-            self._serial.send(c)
+        self._serial.send_many(self._init_cmds)
     def _send_get_config(self):
         get_config_cmd = self.lookup_query_command(
             "get_config",
@@ -564,6 +565,7 @@ class MCU:
                 ["%s=%s" % (k, v) for k, v in self.get_constants().items()]))]
         return "\n".join(log_info)
     def _connect(self):
+        start_time = self._reactor.monotonic()
         config_params = self._send_get_config()
         if not config_params['is_config']:
             if self._restart_method == 'rpi_usb':
@@ -593,21 +595,41 @@ class MCU:
         # Log config information
         move_msg = "Configured MCU '%s' (%d moves)" % (self._name, move_count)
         logging.info(move_msg)
+        self._startup_times.append(("config",
+                                    self._reactor.monotonic() - start_time))
+        logging.info("MCU '%s' startup times: %s", self._name, " ".join(
+            ["%s=%.3fs" % (phase, t) for phase, t in self._startup_times]))
         log_info = self._log_info() + "\n" + move_msg
         self._printer.set_rollover_info(self._name, log_info, log=False)
-    def _mcu_identify(self):
-        if self.is_fileoutput():
-            self._connect_file()
-        else:
+    def _mcu_connect(self, eventtime):
+        # Invoked from a reactor callback so that mcus connect in parallel
+        try:
+            if self.is_fileoutput():
+                self._connect_file()
+                return None
             if (self._restart_method == 'rpi_usb'
                 and not os.path.exists(self._serialport)):
                 # Try toggling usb power
                 self._check_restart("enable power")
+            start_time = self._reactor.monotonic()
             try:
                 self._serial.connect()
+                identify_time = self._reactor.monotonic()
                 self._clocksync.connect(self._serial)
             except serialhdl.error as e:
                 raise error(str(e))
+            curtime = self._reactor.monotonic()
+            self._startup_times = [("identify", identify_time - start_time),
+                                   ("clocksync", curtime - identify_time)]
+            logging.info("MCU '%s' connected in %.3fs (%s)", self._name,
+                         curtime - start_time, self._serial.get_identify_info())
+        except Exception as e:
+            self._clocksync.cancel_connect()
+            if not isinstance(e, (error, msgproto.error, pins.error)):
+                logging.exception("MCU '%s' connect error", self._name)
+            return e
+        return None
+    def _mcu_identify(self):
         logging.info(self._log_info())
         ppins = self._printer.lookup_object('pins')
         pin_resolver = ppins.get_pin_resolver(self._name)
@@ -801,14 +823,32 @@ def error_help(msg):
                 return help_msg
     return ""
 
+# Connect to all mcus concurrently (secondary mcus wait for the main
+# mcu clock during their clock sync)
+def connect_mcus(printer, mcus):
+    reactor = printer.get_reactor()
+    start_time = reactor.monotonic()
+    completions = [reactor.register_callback(m._mcu_connect) for m in mcus]
+    results = [c.wait() for c in completions]
+    for e in results:
+        if e is not None:
+            raise e
+    logging.info("Connected %d MCUs in %.3fs", len(mcus),
+                 reactor.monotonic() - start_time)
+    for m in mcus:
+        m._mcu_identify()
+
 def add_printer_objects(config):
     printer = config.get_printer()
     reactor = printer.get_reactor()
     mainsync = clocksync.ClockSync(reactor)
-    printer.add_object('mcu', MCU(config.getsection('mcu'), mainsync))
+    mcus = [MCU(config.getsection('mcu'), mainsync)]
+    printer.add_object('mcu', mcus[0])
     for s in config.get_prefix_sections('mcu '):
-        printer.add_object(s.section, MCU(
-            s, clocksync.SecondarySync(reactor, mainsync)))
+        mcus.append(MCU(s, clocksync.SecondarySync(reactor, mainsync)))
+        printer.add_object(s.section, mcus[-1])
+    printer.register_event_handler("klippy:mcu_identify",
+                                   (lambda: connect_mcus(printer, mcus)))
 
 def get_printer_mcu(printer, name):
     if name == 'mcu':
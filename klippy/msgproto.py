@@ -22,20 +22,33 @@ MESSAGE_PAYLOAD_MAX = MESSAGE_MAX - MESSAGE_MIN
 MESSAGE_SEQ_MASK = 0x0f
 MESSAGE_DEST = 0x10
 MESSAGE_SYNC = '\x7E'
+MESSAGE_SYNC_BYTE = 0x7E
 
 class error(Exception):
     pass
 
-def crc16_ccitt(buf):
+def _crc16_table():
+    table = []
+    for i in range(256):
+        data = i ^ (i & 0x0f) << 4
+        table.append(((data << 8) ^ (data >> 4) ^ (data << 3)) & 0xffff)
+    return table
+CRC16_TABLE = _crc16_table()
+
+# Calculate the crc of buf[start:end] (buf must be a bytearray)
+def crc16_ccitt_value(buf, start=0, end=None):
+    if end is None:
+        end = len(buf)
     crc = 0xffff
-    for data in buf:
-        data = ord(data)
-        data ^= crc & 0xff
-        data ^= (data & 0x0f) << 4
-        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
-    crc = chr(crc >> 8) + chr(crc & 0xff)
+    table = CRC16_TABLE
+    for i in xrange(start, end):
+        crc = (crc >> 8) ^ table[(crc ^ buf[i]) & 0xff]
     return crc
 
+def crc16_ccitt(buf):
+    crc = crc16_ccitt_value(bytearray(buf))
+    return chr(crc >> 8) + chr(crc & 0xff)
+
 class PT_uint32:
     is_int = True
     is_dynamic_string = False
@@ -128,6 +141,112 @@ def lookup_params(msgformat, enumerations={}):
         out.append((name, pt))
     return out
 
+
+
+######################################################################
+# Generated parse and encode functions
+######################################################################
+
+# The parse() and encode() methods below loop over the message
+# parameters.  For speed, specialized functions are generated for each
+# message.  The generic methods remain available on the class.
+
+def _parse_vlq(s, pos):
+    c = s[pos]
+    pos += 1
+    v = c & 0x7f
+    if (c & 0x60) == 0x60:
+        v |= -0x20
+    while c & 0x80:
+        c = s[pos]
+        pos += 1
+        v = (v<<7) | (c & 0x7f)
+    return v, pos
+
+def _encode_vlq(out, v):
+    if v >= 0xc000000 or v < -0x4000000: out.append((v>>28) & 0x7f | 0x80)
+    if v >= 0x180000 or v < -0x80000:    out.append((v>>21) & 0x7f | 0x80)
+    if v >= 0x3000 or v < -0x1000:       out.append((v>>14) & 0x7f | 0x80)
+    if v >= 0x60 or v < -0x20:           out.append((v>>7)  & 0x7f | 0x80)
+    out.append(v & 0x7f)
+
+def _gen_parse_param(t, var, idx, ns):
+    if isinstance(t, Enumeration):
+        ns['enums%d' % (idx,)] = t.reverse_enums
+        return _gen_parse_param(t.pt, var, idx, ns) + [
+            "tv = enums%d.get(%s)" % (idx, var),
+            "if tv is None:",
+            "    tv = '?%%d' %% (%s,)" % (var,),
+            "%s = tv" % (var,)]
+    if isinstance(t, PT_string):
+        return ["l = s[pos]",
+                "%s = bytes(bytearray(s[pos+1:pos+l+1]))" % (var,),
+                "pos += l + 1"]
+    if isinstance(t, PT_uint32):
+        lines = ["%s = s[pos]" % (var,),
+                 "if %s < 0x60:" % (var,),
+                 "    pos += 1",
+                 "else:",
+                 "    %s, pos = _parse_vlq(s, pos)" % (var,)]
+        if not t.signed:
+            lines.append("    %s = int(%s & 0xffffffff)" % (var, var))
+        return lines
+    ns['t%d' % (idx,)] = t
+    return ["%s, pos = t%d.parse(s, pos)" % (var, idx)]
+
+def _gen_encode_param(t, var, idx, ns):
+    if isinstance(t, Enumeration):
+        ns['enums%d' % (idx,)] = t.enums
+        ns['enum_name%d' % (idx,)] = t.enum_name
+        return [
+            "tv = enums%d.get(%s)" % (idx, var),
+            "if tv is None:",
+            "    raise error(\"Unknown value '%%s' in enumeration '%%s'\""
+            " %% (%s, enum_name%d))" % (var, idx),
+            "%s = tv" % (var,)] + _gen_encode_param(t.pt, var, idx, ns)
+    if isinstance(t, PT_string):
+        return ["out.append(len(%s))" % (var,),
+                "out.extend(bytearray(%s))" % (var,)]
+    if isinstance(t, PT_uint32):
+        return ["if -0x20 <= %s < 0x60:" % (var,),
+                "    out.append(%s & 0x7f)" % (var,),
+                "else:",
+                "    _encode_vlq(out, %s)" % (var,)]
+    ns['t%d' % (idx,)] = t
+    return ["t%d.encode(out, %s)" % (idx, var)]
+
+def _build_function(name, header, body, ns, footer):
+    code = "\n    ".join([header] + body + [footer])
+    exec(compile(code + "\n", "<msgproto %s>" % (name,), "exec"), ns)
+    return ns[name]
+
+# Create a parse(s, pos) function for the given parameter types.  The
+# parsed values are passed to 'result' (a python expression using the
+# variables p0, p1, ...) to build the returned value.
+def gen_parse(param_types, result, ns):
+    ns.update({'_parse_vlq': _parse_vlq})
+    body = ["pos += 1"]
+    for i, t in enumerate(param_types):
+        body.extend(_gen_parse_param(t, "p%d" % (i,), i, ns))
+    return _build_function("parse", "def parse(s, pos):", body, ns,
+                           "return %s, pos" % (result,))
+
+# Create encode(params) and encode_by_name(**params) functions
+def gen_encode(msgid, param_names, ns):
+    ns.update({'_encode_vlq': _encode_vlq, 'error': error, 'msgid': msgid})
+    body = ["out = [msgid]"]
+    by_name_body = ["out = [msgid]"]
+    for i, (name, t) in enumerate(param_names):
+        lines = _gen_encode_param(t, "v", i, ns)
+        body.extend(["v = params[%d]" % (i,)] + lines)
+        by_name_body.extend(["v = params[%s]" % (repr(name),)] + lines)
+    encode = _build_function("encode", "def encode(params):", body, ns,
+                             "return out")
+    encode_by_name = _build_function(
+        "encode_by_name", "def encode_by_name(**params):", by_name_body, ns,
+        "return out")
+    return encode, encode_by_name
+
 # Update the message format to be compatible with python's % operator
 def convert_msg_format(msgformat):
     for c in ['%u', '%i', '%hu', '%hi', '%c', '%.*s', '%*s']:
@@ -143,6 +262,13 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        # Replace the generic methods with generated versions
+        result = "{%s}" % (", ".join([
+            "%s: p%d" % (repr(name), i)
+            for i, (name, t) in enumerate(self.param_names)]),)
+        self.parse = gen_parse(self.param_types, result, {})
+        self.encode, self.encode_by_name = gen_encode(
+            msgid, self.param_names, {})
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -192,6 +318,17 @@ class OutputFormat:
                 else:
                     raise error("Invalid output format for '%s'" % (msgformat,))
             args = args[pos+1:]
+        # Replace the generic parse method with a generated version
+        params = []
+        for i, t in enumerate(self.param_types):
+            if t.is_dynamic_string:
+                params.append("repr(p%d)" % (i,))
+            else:
+                params.append("p%d" % (i,))
+        result = "{'#msg': debugformat %% (%s)}" % (
+            "".join([p + ", " for p in params]),)
+        self.parse = gen_parse(self.param_types, result,
+                               {'debugformat': self.debugformat})
     def parse(self, s, pos):
         pos += 1
         out = []
@@ -226,24 +363,32 @@ class MessageParser:
         self.version = self.build_versions = ""
         self.raw_identify_data = ""
         self._init_messages(DefaultMessages)
-    def check_packet(self, s):
-        if len(s) < MESSAGE_MIN:
+    def check_packet(self, s, pos=0):
+        # Check for a message at s[pos:] - a bytearray is checked in
+        # place, other types are copied
+        if not isinstance(s, bytearray):
+            s = bytearray(s[pos:pos+MESSAGE_MAX])
+            pos = 0
+        avail = len(s) - pos
+        if avail < MESSAGE_MIN:
             return 0
-        msglen = ord(s[MESSAGE_POS_LEN])
+        msglen = s[pos + MESSAGE_POS_LEN]
         if msglen < MESSAGE_MIN or msglen > MESSAGE_MAX:
             return -1
-        msgseq = ord(s[MESSAGE_POS_SEQ])
+        msgseq = s[pos + MESSAGE_POS_SEQ]
         if (msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST:
             return -1
-        if len(s) < msglen:
+        if avail < msglen:
             # Need more data
             return 0
-        if s[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC:
+        end = pos + msglen
+        if s[end - MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC_BYTE:
             return -1
-        msgcrc = s[msglen-MESSAGE_TRAILER_CRC:msglen-MESSAGE_TRAILER_CRC+2]
-        crc = crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
+        crcpos = end - MESSAGE_TRAILER_CRC
+        msgcrc = (s[crcpos] << 8) | s[crcpos + 1]
+        crc = crc16_ccitt_value(s, pos, end - MESSAGE_TRAILER_SIZE)
         if crc != msgcrc:
-            #logging.debug("got crc %s vs %s", repr(crc), repr(msgcrc))
+            #logging.debug("got crc %04x vs %04x", crc, msgcrc)
             return -1
         return msglen
     def dump(self, s):
@@ -275,13 +420,19 @@ class MessageParser:
             raise error("Extra data at end of message")
         params['#name'] = mid.name
         return params
+    def encode_into(self, out, seq, cmd):
+        # Append a framed message to the bytearray 'out'
+        start = len(out)
+        out.append(MESSAGE_MIN + len(cmd))
+        out.append((seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST)
+        out.extend(cmd)
+        crc = crc16_ccitt_value(out, start)
+        out.append(crc >> 8)
+        out.append(crc & 0xff)
+        out.append(MESSAGE_SYNC_BYTE)
+        return out
     def encode(self, seq, cmd):
-        msglen = MESSAGE_MIN + len(cmd)
-        seq = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
-        out = [chr(msglen), chr(seq), cmd]
-        out.append(crc16_ccitt(''.join(out)))
-        out.append(MESSAGE_SYNC)
-        return ''.join(out)
+        return str(self.encode_into(bytearray(), seq, cmd))
     def _parse_buffer(self, value):
         if not value:
             return []
@@ -23,23 +23,29 @@ def main():
 
     f = open(data_filename, 'rb')
     fd = f.fileno()
-    data = ""
+    data = bytearray()
+    pos = 0
     while 1:
-        newdata = os.read(fd, 4096)
+        newdata = os.read(fd, 65536)
         if not newdata:
             break
-        data += newdata
+        # Discard processed data and check messages in place
+        del data[:pos]
+        pos = 0
+        data.extend(newdata)
+        out = []
         while 1:
-            l = mp.check_packet(data)
+            l = mp.check_packet(data, pos)
             if l == 0:
                 break
             if l < 0:
                 logging.error("Invalid data")
-                data = data[-l:]
+                pos += -l
                 continue
-            msgs = mp.dump(bytearray(data[:l]))
-            sys.stdout.write('\n'.join(msgs[1:]) + '\n')
-            data = data[l:]
+            msgs = mp.dump(data[pos:pos+l])
+            out.append('\n'.join(msgs[1:]) + '\n')
+            pos += l
+        sys.stdout.write(''.join(out))
 
 if __name__ == '__main__':
     main()
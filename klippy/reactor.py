@@ -3,17 +3,28 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, Queue as queue
+import os, gc, select, math, time, logging, heapq, bisect, struct, collections
 import greenlet
 import chelper, util
 
 _NOW = 0.
 _NEVER = 9999999999999999.
 
+# Garbage collection scheduling - a collection is only started if its
+# predicted duration (a decaying average of recent collections of that
+# generation, times GC_COST_MARGIN) fits before the next timer, unless
+# it has been deferred for longer than GC_MAX_DEFER seconds.
+GC_COST_MARGIN = 1.5
+GC_COST_DECAY = 0.25
+GC_MAX_DEFER = 5.
+
 class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        # Sequence number of the timer's active heap entry (or None if
+        # the timer is no longer registered)
+        self.heap_seq = 0
 
 class ReactorCompletion:
     class sentinel: pass
@@ -71,6 +82,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return not not self.queue
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -90,6 +103,72 @@ class ReactorMutex:
         self.next_pending = True
         self.reactor.update_timer(self.queue[0].timer, self.reactor.NOW)
 
+# Histogram bucket upper bounds (in seconds) for latency statistics
+LATENCY_BUCKETS = [.0001, .00025, .0005, .001, .0025, .005, .010, .025,
+                   .050, .100, .250, .500, 1.]
+
+# Optional tracking of timer lateness and callback duration
+class ReactorLatencyStats:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.monotonic = reactor.monotonic
+        self.owners = {}
+        self.max_lateness = self.max_duration = 0.
+        self.max_owner = None
+    def _get_owner(self, callback):
+        obj = getattr(callback, '__self__', None)
+        if isinstance(obj, ReactorCallback):
+            # Report register_callback() callbacks by their function
+            callback = obj.callback
+            obj = getattr(callback, '__self__', None)
+        name = getattr(callback, '__name__', '?')
+        if obj is not None:
+            name = "%s.%s" % (obj.__class__.__name__, name)
+        else:
+            name = "%s.%s" % (getattr(callback, '__module__', '?'), name)
+        owner = self.owners.get(name)
+        if owner is None:
+            count = len(LATENCY_BUCKETS) + 1
+            owner = self.owners[name] = {
+                'count': 0, 'lateness': [0] * count, 'duration': [0] * count,
+                'max_lateness': 0., 'max_duration': 0.}
+        return name, owner
+    def _run(self, callback, eventtime, waketime):
+        reactor = self.reactor
+        g_dispatch = reactor._g_dispatch
+        start_time = self.monotonic()
+        res = callback(eventtime)
+        if g_dispatch is not reactor._g_dispatch:
+            # Callback paused - duration not meaningful
+            return res
+        duration = self.monotonic() - start_time
+        name, owner = self._get_owner(callback)
+        owner['count'] += 1
+        owner['duration'][bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+        owner['max_duration'] = max(owner['max_duration'], duration)
+        if duration > self.max_duration:
+            self.max_duration = duration
+            self.max_owner = name
+        if waketime > _NOW:
+            lateness = max(0., start_time - waketime)
+            owner['lateness'][bisect.bisect_left(LATENCY_BUCKETS,
+                                                 lateness)] += 1
+            owner['max_lateness'] = max(owner['max_lateness'], lateness)
+            self.max_lateness = max(self.max_lateness, lateness)
+        return res
+    def run_timer(self, timer_handler, eventtime, waketime):
+        return self._run(timer_handler.callback, eventtime, waketime)
+    def run_fd(self, callback, eventtime):
+        self._run(callback, eventtime, _NOW)
+    def get_histograms(self):
+        return {'buckets': LATENCY_BUCKETS, 'owners': self.owners}
+    def get_recent_max(self):
+        # Return (and reset) the maximum lateness and duration
+        res = (self.max_lateness, self.max_duration, self.max_owner)
+        self.max_lateness = self.max_duration = 0.
+        self.max_owner = None
+        return res
+
 class SelectReactor:
     NOW = _NOW
     NEVER = _NEVER
@@ -100,12 +179,29 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        self._gc_cost = [0., 0., 0.]
+        self._gc_max = [0., 0., 0.]
+        self._gc_total = [0., 0., 0.]
+        self._gc_count = [0, 0, 0]
+        self._gc_deferred = 0
+        self._gc_due_time = None
+        # Latency statistics
+        self._latency_stats = None
+        # Timers - stored in a heap of (waketime, seq, timer) entries.
+        # Entries are not removed when a timer is updated; an entry is
+        # only valid if its seq matches the timer's heap_seq.
+        self._timer_heap = []
+        self._timer_pending = []
+        self._timer_seq = 0
+        self._timer_count = 0
         self._next_timer = self.NEVER
-        # Callbacks
+        # Callbacks - other threads add to the async queue and write to
+        # the wakeup fd (an eventfd, or a pipe if that is unavailable)
+        # if a wakeup is not already pending
         self._pipe_fds = None
-        self._async_queue = queue.Queue()
+        self._async_queue = collections.deque()
+        self._async_signaled = False
+        self._async_wake_data = '.'
         # File descriptors
         self._fds = []
         # Greenlets
@@ -114,51 +210,117 @@ class SelectReactor:
         self._all_greenlets = []
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def get_gc_pause_stats(self):
+        # Return (count, total time, max time, predicted time) for each
+        # generation along with the number of deferred collections
+        return (tuple(zip(self._gc_count, self._gc_total, self._gc_max,
+                          self._gc_cost)), self._gc_deferred)
+    def _run_gc(self, eventtime):
+        gi = gc.get_count()
+        if gi[0] < 700:
+            return False
+        gc_level = 0
+        if gi[1] >= 10:
+            gc_level = 1
+            if gi[2] >= 10:
+                gc_level = 2
+        # Check if the collection is likely to delay the next timer
+        if self._gc_due_time is None:
+            self._gc_due_time = eventtime
+        predicted = self._gc_cost[gc_level] * GC_COST_MARGIN
+        if (eventtime + predicted > self._next_timer
+            and eventtime < self._gc_due_time + GC_MAX_DEFER):
+            self._gc_deferred += 1
+            return False
+        self._gc_due_time = None
+        self._last_gc_times[gc_level] = eventtime
+        start_time = self.monotonic()
+        gc.collect(gc_level)
+        duration = self.monotonic() - start_time
+        self._gc_count[gc_level] += 1
+        self._gc_total[gc_level] += duration
+        self._gc_max[gc_level] = max(self._gc_max[gc_level], duration)
+        cost = self._gc_cost[gc_level]
+        if not cost:
+            self._gc_cost[gc_level] = duration
+        else:
+            self._gc_cost[gc_level] = cost + (duration - cost) * GC_COST_DECAY
+        return True
+    def enable_latency_stats(self):
+        if self._latency_stats is None:
+            self._latency_stats = ReactorLatencyStats(self)
+        return self._latency_stats
     # Timers
-    def update_timer(self, timer_handler, waketime):
+    def _set_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
+        if timer_handler.heap_seq is None:
+            return
+        self._timer_seq += 1
+        timer_handler.heap_seq = self._timer_seq
+        if waketime >= self.NEVER:
+            return
+        # New entries are added to the heap on the next _check_timers()
+        # pass so that a timer runs at most once per pass
+        self._timer_pending.append((waketime, self._timer_seq, timer_handler))
         self._next_timer = min(self._next_timer, waketime)
+    def update_timer(self, timer_handler, waketime):
+        if waketime != timer_handler.waketime:
+            self._set_timer(timer_handler, waketime)
     def register_timer(self, callback, waketime=NEVER):
-        timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        timer_handler = ReactorTimer(callback, self.NEVER)
+        self._timer_count += 1
+        self._set_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        if timer_handler.heap_seq is not None:
+            timer_handler.heap_seq = None
+            self._timer_count -= 1
+    def _merge_timers(self):
+        heap = self._timer_heap
+        pending = self._timer_pending
+        self._timer_pending = []
+        if len(heap) + len(pending) > 4 * self._timer_count + 64:
+            # Too many stale entries - rebuild the heap
+            heap = [e for e in heap + pending if e[1] == e[2].heap_seq]
+            heapq.heapify(heap)
+            self._timer_heap = heap
+            return heap
+        for entry in pending:
+            heapq.heappush(heap, entry)
+        return heap
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
                 return 0.
-            if self._check_gc:
-                gi = gc.get_count()
-                if gi[0] >= 700:
-                    # Reactor looks idle and gc is due - run it
-                    gc_level = 0
-                    if gi[1] >= 10:
-                        gc_level = 1
-                        if gi[2] >= 10:
-                            gc_level = 2
-                    self._last_gc_times[gc_level] = eventtime
-                    gc.collect(gc_level)
-                    return 0.
+            if self._check_gc and self._run_gc(eventtime):
+                # Reactor looked idle and gc was due - it was run
+                return 0.
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
+        heap = self._timer_heap
+        if self._timer_pending:
+            heap = self._merge_timers()
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        while heap:
+            waketime, seq, t = heap[0]
+            if seq != t.heap_seq:
+                # Stale entry
+                heapq.heappop(heap)
+                continue
+            if eventtime < waketime:
+                self._next_timer = min(self._next_timer, waketime)
+                break
+            heapq.heappop(heap)
+            t.waketime = self.NEVER
+            if self._latency_stats is None:
+                self._set_timer(t, t.callback(eventtime))
+            else:
+                self._set_timer(t, self._latency_stats.run_timer(
+                    t, eventtime, waketime))
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return 0.
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -167,34 +329,41 @@ class SelectReactor:
         rcb = ReactorCallback(self, callback, waketime)
         return rcb.completion
     # Asynchronous (from another thread) callbacks and completions
-    def register_async_callback(self, callback, waketime=NOW):
-        self._async_queue.put_nowait(
-            (ReactorCallback, (self, callback, waketime)))
+    def _async_signal(self):
+        self._async_signaled = True
         try:
-            os.write(self._pipe_fds[1], '.')
+            os.write(self._pipe_fds[1], self._async_wake_data)
         except os.error:
             pass
+    def register_async_callback(self, callback, waketime=NOW):
+        self._async_queue.append((ReactorCallback, (self, callback, waketime)))
+        if not self._async_signaled:
+            self._async_signal()
     def async_complete(self, completion, result):
-        self._async_queue.put_nowait((completion.complete, (result,)))
-        try:
-            os.write(self._pipe_fds[1], '.')
-        except os.error:
-            pass
+        self._async_queue.append((completion.complete, (result,)))
+        if not self._async_signaled:
+            self._async_signal()
     def _got_pipe_signal(self, eventtime):
         try:
             os.read(self._pipe_fds[0], 4096)
         except os.error:
             pass
-        while 1:
-            try:
-                func, args = self._async_queue.get_nowait()
-            except queue.Empty:
-                break
+        # Clear the flag before processing the queue so that any item
+        # added after this point results in a new wakeup
+        self._async_signaled = False
+        async_queue = self._async_queue
+        while async_queue:
+            func, args = async_queue.popleft()
             func(*args)
     def _setup_async_callbacks(self):
-        self._pipe_fds = os.pipe()
-        util.set_nonblock(self._pipe_fds[0])
-        util.set_nonblock(self._pipe_fds[1])
+        efd = chelper.get_ffi()[1].create_eventfd()
+        if efd >= 0:
+            self._pipe_fds = (efd, efd)
+            self._async_wake_data = struct.pack('=Q', 1)
+        else:
+            self._pipe_fds = os.pipe()
+            util.set_nonblock(self._pipe_fds[0])
+            util.set_nonblock(self._pipe_fds[1])
         self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
     # Greenlets
     def _sys_pause(self, waketime):
@@ -254,7 +423,10 @@ class SelectReactor:
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.callback(eventtime)
+                if self._latency_stats is None:
+                    fd.callback(eventtime)
+                else:
+                    self._latency_stats.run_fd(fd.callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -279,8 +451,8 @@ class SelectReactor:
                 logging.exception("reactor finalize greenlet terminate")
         self._all_greenlets = []
         if self._pipe_fds is not None:
-            os.close(self._pipe_fds[0])
-            os.close(self._pipe_fds[1])
+            for fd in set(self._pipe_fds):
+                os.close(fd)
             self._pipe_fds = None
 
 class PollReactor(SelectReactor):
@@ -313,7 +485,10 @@ class PollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                if self._latency_stats is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._latency_stats.run_fd(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -350,7 +525,10 @@ class EPollReactor(SelectReactor):
             eventtime = self.monotonic()
             for fd, event in res:
                 busy = True
-                self._fds[fd](eventtime)
+                if self._latency_stats is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._latency_stats.run_fd(self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import os, logging, threading, hashlib, zlib
 import serial
 
 import msgproto, chelper, util
@@ -13,10 +13,12 @@ class error(Exception):
 
 class SerialReader:
     BITS_PER_BYTE = 10.
-    def __init__(self, reactor, serialport, baud, rts=True):
+    def __init__(self, reactor, serialport, baud, rts=True, dict_cache=None):
         self.reactor = reactor
         self.serialport = serialport
         self.baud = baud
+        self.dict_cache = dict_cache
+        self.identify_info = ""
         # Serial port
         self.ser = None
         self.rts = rts
@@ -29,6 +31,7 @@ class SerialReader:
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
+        self.bg_cputime = 0.
         # Message handlers
         self.handlers = {}
         self.register_response(self._handle_unknown_init, '#unknown')
@@ -37,44 +40,66 @@ class SerialReader:
         self.last_notify_id = 0
         self.pending_notifications = {}
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (PULL_BATCH,))
+        msg_size = self.ffi_main.sizeof('struct pull_queue_message')
+        ffi_buffer = self.ffi_main.buffer
+        pull_batch = self.ffi_lib.serialqueue_pull_batch
+        get_thread_cputime = self.ffi_lib.get_thread_cputime
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = pull_batch(self.serialqueue, responses, PULL_BATCH)
             if count < 0:
                 break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
-                continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
-                    hdl(params)
-            except:
-                logging.exception("Exception in serial callback")
+            # Copy all message contents to python with a single copy
+            data = bytearray(ffi_buffer(responses, count * msg_size))
+            msgparser = self.msgparser
+            # Handle the messages in order while taking the lock once per
+            # batch (a handler may not run after it is unregistered)
+            with self.lock:
+                for i in range(count):
+                    response = responses[i]
+                    if response.notify_id:
+                        params = {'#sent_time': response.sent_time,
+                                  '#receive_time': response.receive_time}
+                        completion = self.pending_notifications.pop(
+                            response.notify_id)
+                        self.reactor.async_complete(completion, params)
+                        continue
+                    pos = i * msg_size
+                    params = msgparser.parse(data[pos:pos+response.len])
+                    params['#sent_time'] = response.sent_time
+                    params['#receive_time'] = response.receive_time
+                    hdl = (params['#name'], params.get('oid'))
+                    try:
+                        hdl = self.handlers.get(hdl, self.handle_default)
+                        hdl(params)
+                    except:
+                        logging.exception("Exception in serial callback")
+            self.bg_cputime = get_thread_cputime()
+    def _send_identify(self, offset):
+        msg = "identify offset=%d count=%d" % (offset, IDENTIFY_CHUNK)
+        while 1:
+            params = self.send_with_response(msg, 'identify_response')
+            if params['offset'] == offset:
+                return params['data']
     def _get_identify_data(self, eventtime):
         # Query the "data dictionary" from the micro-controller
-        identify_data = ""
-        while 1:
-            msg = "identify offset=%d count=%d" % (len(identify_data), 40)
-            try:
-                params = self.send_with_response(msg, 'identify_response')
-            except error as e:
-                logging.exception("Wait for identify_response")
-                return None
-            if params['offset'] == len(identify_data):
-                msgdata = params['data']
+        try:
+            identify_data = self._send_identify(0)
+            if self.dict_cache is not None and identify_data:
+                data = self.dict_cache.lookup(identify_data,
+                                              self._send_identify)
+                if data is not None:
+                    return data, True
+            while 1:
+                msgdata = self._send_identify(len(identify_data))
                 if not msgdata:
                     # Done
-                    return identify_data
+                    return identify_data, False
                 identify_data += msgdata
+        except error as e:
+            logging.exception("Wait for identify_response")
+            return None
     def connect(self):
         # Initial connection
         logging.info("Starting serial connect")
@@ -104,15 +129,22 @@ class SerialReader:
             self.background_thread = threading.Thread(target=self._bg_thread)
             self.background_thread.start()
             # Obtain and load the data dictionary from the firmware
+            identify_time = self.reactor.monotonic()
             completion = self.reactor.register_callback(self._get_identify_data)
-            identify_data = completion.wait(connect_time + 5.)
-            if identify_data is not None:
+            result = completion.wait(connect_time + 5.)
+            if result is not None:
                 break
             logging.info("Timeout on serial connect")
             self.disconnect()
+        identify_data, from_cache = result
         msgparser = msgproto.MessageParser()
         msgparser.process_identify(identify_data)
         self.msgparser = msgparser
+        self.identify_info = "data dictionary %d bytes from %s in %.3fs" % (
+            len(identify_data), ["mcu", "cache"][from_cache],
+            self.reactor.monotonic() - identify_time)
+        if self.dict_cache is not None and not from_cache:
+            self.dict_cache.store(identify_data)
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
         mcu_baud = msgparser.get_constant_float('SERIAL_BAUD', None)
@@ -150,11 +182,14 @@ class SerialReader:
             return ""
         self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
-        return self.ffi_main.string(self.stats_buf)
+        return "%s reader_cpu=%.3f" % (self.ffi_main.string(self.stats_buf),
+                                       self.bg_cputime)
     def get_reactor(self):
         return self.reactor
     def get_msgparser(self):
         return self.msgparser
+    def get_identify_info(self):
+        return self.identify_info
     def get_default_command_queue(self):
         return self.default_cmd_queue
     # Serial response callbacks
@@ -168,6 +203,15 @@ class SerialReader:
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
                                       cmd, len(cmd), minclock, reqclock, 0)
+    def raw_send_many(self, cmds, minclock, reqclock, cmd_queue):
+        # Submit a list of encoded commands to the serialqueue in one batch
+        data = bytearray()
+        for cmd in cmds:
+            data.append(len(cmd))
+            data.extend(cmd)
+        self.ffi_lib.serialqueue_send_many(self.serialqueue, cmd_queue,
+                                           str(data), len(data),
+                                           minclock, reqclock)
     def raw_send_wait_ack(self, cmd, minclock, reqclock, cmd_queue):
         self.last_notify_id += 1
         nid = self.last_notify_id
@@ -182,6 +226,9 @@ class SerialReader:
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
+    def send_many(self, msgs, minclock=0, reqclock=0):
+        cmds = [self.msgparser.create_command(msg) for msg in msgs]
+        self.raw_send_many(cmds, minclock, reqclock, self.default_cmd_queue)
     def send_with_response(self, msg, response):
         cmd = self.msgparser.create_command(msg)
         src = SerialRetryCommand(self, response)
@@ -225,6 +272,83 @@ class SerialReader:
     def handle_default(self, params):
         logging.warn("got %s", params)
 
+PULL_BATCH = 32
+IDENTIFY_CHUNK = 40
+DICT_CACHE_MAX_FILES = 32
+
+# On-disk cache of compressed mcu data dictionaries.  Entries are
+# named by a hash of the first identify chunk and the total length.
+# A cached entry is only used after the mcu confirms its final chunk
+# (which contains the zlib adler32 of the full dictionary) and that no
+# data follows it.  On any mismatch the entry is deleted and the full
+# dictionary is transferred from the mcu (and then stored again).
+class DictionaryCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+    def _get_prefix(self, first_chunk):
+        return "%s-" % (hashlib.sha1(first_chunk).hexdigest(),)
+    def _get_filename(self, data):
+        return "%s%d.dict" % (self._get_prefix(data[:IDENTIFY_CHUNK]),
+                              len(data))
+    def _verify(self, data, send_identify):
+        tail_offset = max(0, len(data) - IDENTIFY_CHUNK)
+        if send_identify(tail_offset) != data[tail_offset:]:
+            return False
+        if send_identify(len(data)):
+            return False
+        try:
+            zlib.decompress(data)
+        except zlib.error as e:
+            return False
+        return True
+    def lookup(self, first_chunk, send_identify):
+        prefix = self._get_prefix(first_chunk)
+        try:
+            fnames = [fname for fname in os.listdir(self.cache_dir)
+                      if fname.startswith(prefix)]
+        except OSError as e:
+            return None
+        for fname in fnames:
+            try:
+                f = open(os.path.join(self.cache_dir, fname), 'rb')
+                data = f.read()
+                f.close()
+            except IOError as e:
+                continue
+            if (fname == self._get_filename(data)
+                and self._verify(data, send_identify)):
+                return data
+            logging.info("Data dictionary cache mismatch on %s"
+                         " - transferring from mcu", fname)
+            try:
+                os.unlink(os.path.join(self.cache_dir, fname))
+            except OSError as e:
+                pass
+        return None
+    def _prune(self):
+        fnames = [os.path.join(self.cache_dir, fname)
+                  for fname in os.listdir(self.cache_dir)
+                  if fname.endswith('.dict')]
+        if len(fnames) <= DICT_CACHE_MAX_FILES:
+            return
+        fnames.sort(key=os.path.getmtime)
+        for fname in fnames[:-DICT_CACHE_MAX_FILES]:
+            os.unlink(fname)
+    def store(self, data):
+        fname = os.path.join(self.cache_dir, self._get_filename(data))
+        tmpname = "%s.tmp%d" % (fname, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            f = open(tmpname, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(tmpname, fname)
+            self._prune()
+        except (IOError, OSError) as e:
+            logging.warn("Unable to write data dictionary cache %s: %s",
+                         fname, e)
+
 # Class to send a query command and return the received response
 class SerialRetryCommand:
     def __init__(self, serial, name, oid=None):
@@ -154,21 +154,28 @@ class MCU_stepper:
         return old_tq
     def add_active_callback(self, cb):
         self._active_callbacks.append(cb)
-    def generate_steps(self, flush_time):
+    def _run_active_callbacks(self, active_time):
+        cbs = self._active_callbacks
+        self._active_callbacks = []
+        for cb in cbs:
+            cb(active_time)
+    def generate_steps(self, flush_time, defer_callbacks=False):
         # Check for activity if necessary
+        deferred = None
         if self._active_callbacks:
-            ret = self._itersolve_check_active(self._stepper_kinematics,
-                                               flush_time)
-            if ret:
-                cbs = self._active_callbacks
-                self._active_callbacks = []
-                for cb in cbs:
-                    cb(ret)
+            active_time = self._itersolve_check_active(
+                self._stepper_kinematics, flush_time)
+            if active_time and defer_callbacks:
+                # Caller (not a step generation thread) runs the callbacks
+                deferred = (lambda: self._run_active_callbacks(active_time))
+            elif active_time:
+                self._run_active_callbacks(active_time)
         # Generate steps
         ret = self._itersolve_generate_steps(self._stepper_kinematics,
                                              flush_time)
         if ret:
             raise error("Internal error in stepcompress")
+        return deferred
     def is_active_axis(self, axis):
         return self._ffi_lib.itersolve_is_active_axis(
             self._stepper_kinematics, axis)
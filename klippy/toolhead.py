@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, importlib
+import math, logging, importlib, threading, Queue as queue
 import mcu, homing, chelper, kinematics.extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
@@ -11,17 +11,31 @@ import mcu, homing, chelper, kinematics.extruder
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
 # Class to track each move request
-class Move:
+class Move(object):
+    # A Move is allocated for every G1 - use slots to reduce the memory
+    # and allocation overhead of each instance
+    __slots__ = ['toolhead', 'start_pos', 'end_pos', 'accel',
+                 'timing_callbacks', 'is_kinematic_move', 'axes_d',
+                 'move_d', 'axes_r', 'min_move_t', 'max_start_v2',
+                 'max_cruise_v2', 'delta_v2', 'max_smoothed_v2',
+                 'smooth_delta_v2', 'start_v', 'cruise_v', 'end_v',
+                 'accel_t', 'cruise_t', 'decel_t', 'la_state']
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
-        self.timing_callbacks = []
+        # The timing_callbacks list is only allocated when needed
+        self.timing_callbacks = ()
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        self.axes_d = axes_d = [end_pos[0] - start_pos[0],
+                                end_pos[1] - start_pos[1],
+                                end_pos[2] - start_pos[2],
+                                end_pos[3] - start_pos[3]]
+        self.move_d = move_d = math.sqrt(axes_d[0]*axes_d[0]
+                                         + axes_d[1]*axes_d[1]
+                                         + axes_d[2]*axes_d[2])
         if move_d < .000000001:
             # Extrude only move
             self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
@@ -36,7 +50,8 @@ class Move:
             self.is_kinematic_move = False
         else:
             inv_move_d = 1. / move_d
-        self.axes_r = [d * inv_move_d for d in axes_d]
+        self.axes_r = [axes_d[0] * inv_move_d, axes_d[1] * inv_move_d,
+                       axes_d[2] * inv_move_d, axes_d[3] * inv_move_d]
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -114,25 +129,28 @@ class MoveQueue:
         self.toolhead = toolhead
         self.queue = []
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        # Incremental look-ahead state - the queue index of a move with
+        # junction speeds that are no longer impacted by new moves, and
+        # the queue index of each move that starts an acceleration peak
+        self.stable_index = -1
+        self.peaks = []
     def reset(self):
         del self.queue[:]
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.stable_index = -1
+        del self.peaks[:]
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
     def get_last(self):
         if self.queue:
             return self.queue[-1]
         return None
-    def flush(self, lazy=False):
-        self.junction_flush = LOOKAHEAD_FLUSH_TIME
-        update_flush_count = lazy
-        queue = self.queue
-        flush_count = len(queue)
+    def _set_junctions(self, flush_count, next_end_v2, next_smoothed_v2,
+                       peak_cruise_v2):
         # Traverse queue from last to first move and determine maximum
-        # junction speed assuming the robot comes to a complete stop
-        # after the last move.
+        # junction speed of each move that is to be flushed
+        queue = self.queue
         delayed = []
-        next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
         for i in range(flush_count-1, -1, -1):
             move = queue[i]
             reachable_start_v2 = next_end_v2 + move.delta_v2
@@ -145,36 +163,106 @@ class MoveQueue:
                     or delayed):
                     # This move can decelerate or this is a full accel
                     # move after a full decel move
-                    if update_flush_count and peak_cruise_v2:
-                        flush_count = i
-                        update_flush_count = False
                     peak_cruise_v2 = min(move.max_cruise_v2, (
                         smoothed_v2 + reachable_smoothed_v2) * .5)
                     if delayed:
                         # Propagate peak_cruise_v2 to any delayed moves
-                        if not update_flush_count and i < flush_count:
-                            mc_v2 = peak_cruise_v2
-                            for m, ms_v2, me_v2 in reversed(delayed):
-                                mc_v2 = min(mc_v2, ms_v2)
-                                m.set_junction(min(ms_v2, mc_v2), mc_v2
-                                               , min(me_v2, mc_v2))
+                        mc_v2 = peak_cruise_v2
+                        for m, ms_v2, me_v2 in reversed(delayed):
+                            mc_v2 = min(mc_v2, ms_v2)
+                            m.set_junction(min(ms_v2, mc_v2), mc_v2
+                                           , min(me_v2, mc_v2))
                         del delayed[:]
-                if not update_flush_count and i < flush_count:
-                    cruise_v2 = min((start_v2 + reachable_start_v2) * .5
-                                    , move.max_cruise_v2, peak_cruise_v2)
-                    move.set_junction(min(start_v2, cruise_v2), cruise_v2
-                                      , min(next_end_v2, cruise_v2))
+                cruise_v2 = min((start_v2 + reachable_start_v2) * .5
+                                , move.max_cruise_v2, peak_cruise_v2)
+                move.set_junction(min(start_v2, cruise_v2), cruise_v2
+                                  , min(next_end_v2, cruise_v2))
             else:
                 # Delay calculating this move until peak_cruise_v2 is known
                 delayed.append((move, start_v2, next_end_v2))
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
-        if update_flush_count or not flush_count:
-            return
+    def _find_flush_count(self):
+        # Traverse queue from last to first move and determine maximum
+        # junction speed assuming the robot comes to a complete stop
+        # after the last move.  Moves prior to the second to last
+        # acceleration peak may be flushed.
+        queue = self.queue
+        stable_index = self.stable_index
+        peaks = self.peaks
+        new_peaks = []
+        flush_count = None
+        new_stable_index = -1
+        next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
+        next_can_accel = True
+        for i in range(len(queue)-1, -1, -1):
+            move = queue[i]
+            reachable_start_v2 = next_end_v2 + move.delta_v2
+            start_v2 = min(move.max_start_v2, reachable_start_v2)
+            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
+            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+            can_accel = smoothed_v2 < reachable_smoothed_v2
+            if can_accel and (smoothed_v2 + move.smooth_delta_v2
+                              > next_smoothed_v2 or not next_can_accel):
+                # This move can decelerate or this is a full accel
+                # move after a full decel move
+                if peak_cruise_v2:
+                    flush_count = i
+                peak_cruise_v2 = min(move.max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5)
+                move.la_state = (start_v2, smoothed_v2, peak_cruise_v2)
+                new_peaks.append(i)
+            if (new_stable_index < 0 and can_accel
+                and move.max_start_v2 <= reachable_start_v2):
+                # Adding moves only increases the reachable speeds, so
+                # the junction speeds of this move (and all prior
+                # moves) can no longer change
+                new_stable_index = i
+            if flush_count is not None:
+                break
+            if i == stable_index:
+                # Prior moves are unchanged since the last traversal -
+                # find the flush position from the recorded peaks
+                for peak_index in reversed(peaks):
+                    if peak_index >= i:
+                        continue
+                    if peak_cruise_v2:
+                        flush_count = peak_index
+                        break
+                    peak_cruise_v2 = queue[peak_index].la_state[2]
+                break
+            next_end_v2 = start_v2
+            next_smoothed_v2 = smoothed_v2
+            next_can_accel = can_accel
+        # Update list of peaks
+        while peaks and peaks[-1] >= i:
+            peaks.pop()
+        peaks.extend(reversed(new_peaks))
+        self.stable_index = new_stable_index
+        return flush_count
+    def flush(self, lazy=False):
+        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        queue = self.queue
+        if lazy:
+            flush_count = self._find_flush_count()
+            if not flush_count:
+                return
+            next_end_v2, next_smoothed_v2, peak_cruise_v2 = (
+                queue[flush_count].la_state)
+            self._set_junctions(flush_count, next_end_v2, next_smoothed_v2,
+                                peak_cruise_v2)
+        else:
+            flush_count = len(queue)
+            if not flush_count:
+                return
+            self._set_junctions(flush_count, 0., 0., 0.)
         # Generate step times for all moves ready to be flushed
         self.toolhead._process_moves(queue[:flush_count])
         # Remove processed moves from the queue
         del queue[:flush_count]
+        self.stable_index = max(-1, self.stable_index - flush_count)
+        self.peaks[:] = [i - flush_count for i in self.peaks
+                         if i >= flush_count]
     def add_move(self, move):
         self.queue.append(move)
         if len(self.queue) == 1:
@@ -194,6 +282,64 @@ DRIP_TIME = 0.100
 class DripModeEndSignal(Exception):
     pass
 
+# Helper thread pool to run step generators in parallel.  The bulk of
+# the step generation work is done in C code (which runs without the
+# python GIL held) so several steppers can be processed concurrently.
+class StepGenerationPool:
+    def __init__(self, num_threads):
+        self.work_queue = queue.Queue()
+        self.done_queue = queue.Queue()
+        self.threads = []
+        for i in range(num_threads):
+            t = threading.Thread(target=self._worker_thread)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+    def _worker_thread(self):
+        while 1:
+            work = self.work_queue.get(True)
+            if work is None:
+                break
+            sg, flush_time = work
+            try:
+                deferred = sg(flush_time, defer_callbacks=True)
+            except Exception as e:
+                logging.exception("Error in step generation thread")
+                self.done_queue.put((e, None))
+                continue
+            self.done_queue.put((None, deferred))
+    def generate_steps(self, step_generators, flush_time):
+        # Dispatch all but the first generator to the worker threads
+        # and run the first one in the calling thread
+        for sg in step_generators[1:]:
+            self.work_queue.put((sg, flush_time))
+        err = None
+        deferred = []
+        try:
+            deferred.append(step_generators[0](flush_time,
+                                               defer_callbacks=True))
+        except Exception as e:
+            err = e
+        # Wait for all the worker threads to complete
+        for i in range(len(step_generators) - 1):
+            res, cb = self.done_queue.get(True)
+            if res is not None and err is None:
+                err = res
+            deferred.append(cb)
+        if err is not None:
+            raise err
+        # Stepper activity callbacks use the reactor and mcu command
+        # queues, so they must run in the main thread
+        for cb in deferred:
+            if cb is not None:
+                cb()
+    def stop(self):
+        for t in self.threads:
+            self.work_queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
 # Main code to track events (and their timing) on the printer toolhead
 class ToolHead:
     def __init__(self, config):
@@ -247,8 +393,18 @@ class ToolHead:
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
         self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
         self.trapq_free_moves = ffi_lib.trapq_free_moves
+        self.ffi_main = ffi_main
         self.step_generators = []
+        self.step_gen_pool = None
+        self.step_gen_time = self.step_gen_max = 0.
+        step_gen_threads = config.getint('step_generation_threads', 0,
+                                         minval=0)
+        if step_gen_threads:
+            self.step_gen_pool = StepGenerationPool(step_gen_threads)
+            self.printer.register_event_handler("klippy:disconnect",
+                                                self._handle_disconnect)
         # Create kinematics class
         self.extruder = kinematics.extruder.DummyExtruder(self.printer)
         kin_name = config.get('kinematics')
@@ -281,11 +437,21 @@ class ToolHead:
         batch_time = MOVE_BATCH_TIME
         kin_flush_delay = self.kin_flush_delay
         lkft = self.last_kin_flush_time
+        step_gen_pool = self.step_gen_pool
+        monotonic = self.reactor.monotonic
         while 1:
             self.print_time = min(self.print_time + batch_time, next_print_time)
             sg_flush_time = max(lkft, self.print_time - kin_flush_delay)
-            for sg in self.step_generators:
-                sg(sg_flush_time)
+            if step_gen_pool is not None and len(self.step_generators) > 1:
+                start_time = monotonic()
+                step_gen_pool.generate_steps(self.step_generators,
+                                             sg_flush_time)
+                step_gen_time = monotonic() - start_time
+                self.step_gen_time += step_gen_time
+                self.step_gen_max = max(self.step_gen_max, step_gen_time)
+            else:
+                for sg in self.step_generators:
+                    sg(sg_flush_time)
             free_time = max(lkft, sg_flush_time - kin_flush_delay)
             self.trapq_free_moves(self.trapq, free_time)
             self.extruder.update_move_time(free_time)
@@ -315,25 +481,46 @@ class ToolHead:
             self._calc_print_time()
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
+        trapq_data = []
+        trapq_count = 0
+        extruder_moves = []
         for move in moves:
             if move.is_kinematic_move:
-                self.trapq_append(
-                    self.trapq, next_move_time,
-                    move.accel_t, move.cruise_t, move.decel_t,
-                    move.start_pos[0], move.start_pos[1], move.start_pos[2],
-                    move.axes_r[0], move.axes_r[1], move.axes_r[2],
-                    move.start_v, move.cruise_v, move.accel)
+                start_pos = move.start_pos
+                axes_r = move.axes_r
+                trapq_data.extend((
+                    next_move_time, move.accel_t, move.cruise_t, move.decel_t,
+                    start_pos[0], start_pos[1], start_pos[2],
+                    axes_r[0], axes_r[1], axes_r[2],
+                    move.start_v, move.cruise_v, move.accel))
+                trapq_count += 1
             if move.axes_d[3]:
-                self.extruder.move(next_move_time, move)
+                extruder_moves.append((next_move_time, move))
             next_move_time = (next_move_time + move.accel_t
                               + move.cruise_t + move.decel_t)
-            for cb in move.timing_callbacks:
-                cb(next_move_time)
+            if move.timing_callbacks:
+                # Callbacks run after their move is queued (and in order)
+                self._queue_batch(trapq_data, trapq_count, extruder_moves)
+                trapq_data = []
+                trapq_count = 0
+                extruder_moves = []
+                for cb in move.timing_callbacks:
+                    cb(next_move_time)
+        self._queue_batch(trapq_data, trapq_count, extruder_moves)
         # Generate steps for moves
         if self.special_queuing_state:
             self._update_drip_move_time(next_move_time)
         self._update_move_time(next_move_time)
         self.last_kin_move_time = next_move_time
+    def _queue_batch(self, trapq_data, trapq_count, extruder_moves):
+        # Submit kinematic moves to the trapq in a single call
+        if trapq_count:
+            data = self.ffi_main.new("double[]", trapq_data)
+            self.trapq_append_batch(
+                self.trapq, self.ffi_main.cast("struct trapq_append_data *",
+                                               data), trapq_count)
+        if extruder_moves:
+            self.extruder.queue_moves(extruder_moves)
     def flush_step_generation(self):
         # Transition from "Flushed"/"Priming"/main state to "Flushed" state
         self.move_queue.flush()
@@ -489,8 +676,18 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.special_queuing_state
         if self.special_queuing_state == "Drip":
             buffer_time = 0.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
-            self.print_time, max(buffer_time, 0.), self.print_stall)
+        buffer_time = max(buffer_time, 0.)
+        msg = "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
+            self.print_time, buffer_time, self.print_stall)
+        fields = {'print_time': self.print_time, 'buffer_time': buffer_time,
+                  'print_stall': self.print_stall}
+        if self.step_gen_pool is not None:
+            msg += " step_gen_time=%.3f step_gen_max=%.6f" % (
+                self.step_gen_time, self.step_gen_max)
+            fields['step_gen_time'] = self.step_gen_time
+            fields['step_gen_max'] = self.step_gen_max
+            self.step_gen_max = 0.
+        return is_active, msg, fields
     def check_busy(self, eventtime):
         est_print_time = self.mcu.estimated_print_time(eventtime)
         lookahead_empty = not self.move_queue.queue
@@ -511,6 +708,8 @@ class ToolHead:
     def _handle_shutdown(self):
         self.can_pause = False
         self.move_queue.reset()
+    def _handle_disconnect(self):
+        self.step_gen_pool.stop()
     def get_kinematics(self):
         return self.kin
     def get_trapq(self):
@@ -531,6 +730,8 @@ class ToolHead:
         if last_move is None:
             callback(self.get_last_move_time())
             return
+        if not last_move.timing_callbacks:
+            last_move.timing_callbacks = []
         last_move.timing_callbacks.append(callback)
     def note_kinematic_activity(self, kin_time):
         self.last_kin_move_time = max(self.last_kin_move_time, kin_time)
@@ -362,6 +362,10 @@ class GCodeHelper:
 
 SUBSCRIPTION_REFRESH_TIME = .25
 
+# Printer objects may implement get_status_version() to return a value
+# that changes whenever get_status() could return different data.
+# When it is unchanged, get_status() is not called and no update is
+# sent to subscribers.
 class QueryStatusHelper:
     def __init__(self, printer):
         self.printer = printer
@@ -369,18 +373,49 @@ class QueryStatusHelper:
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        self.last_versions = {}
+        self.status_stats = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
         webhooks.register_endpoint("objects/query", self._handle_query)
         webhooks.register_endpoint("objects/subscribe", self._handle_subscribe)
+        webhooks.register_endpoint("objects/query_stats",
+                                   self._handle_query_stats)
     def _handle_list(self, web_request):
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _handle_query_stats(self, web_request):
+        web_request.send({n: {'calls': calls, 'skipped': skipped,
+                              'time': round(t, 6)}
+                          for n, (calls, skipped, t)
+                          in self.status_stats.items()})
+    def _get_status(self, obj_name, eventtime, last_query, unchanged):
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}
+        stats = self.status_stats.get(obj_name)
+        if stats is None:
+            stats = self.status_stats[obj_name] = [0, 0, 0.]
+        if hasattr(po, 'get_status_version'):
+            version = po.get_status_version(eventtime)
+            if (obj_name in last_query and obj_name in self.last_versions
+                and self.last_versions[obj_name] == version):
+                stats[1] += 1
+                unchanged[obj_name] = True
+                return last_query[obj_name]
+            self.last_versions[obj_name] = version
+        reactor = self.printer.get_reactor()
+        start_time = reactor.monotonic()
+        res = po.get_status(eventtime)
+        stats[0] += 1
+        stats[2] += reactor.monotonic() - start_time
+        return res
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
+        unchanged = {}
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
@@ -395,15 +430,14 @@ class QueryStatusHelper:
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                    res = query[obj_name] = self._get_status(
+                        obj_name, eventtime, last_query, unchanged)
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
+                if obj_name in unchanged and not is_query:
+                    continue
                 lres = last_query.get(obj_name, {})
                 cres = {}
                 for ri in req_items:
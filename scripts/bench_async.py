@@ -0,0 +1,62 @@
+#!/usr/bin/env python2
+# Benchmark reactor completions from a background thread
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, threading
+
+# Simulate serialhdl._bg_thread - the background thread delivers
+# responses (via async_complete) in bursts of 'burst' messages
+def bench_completions(reactor, count, burst):
+    r = reactor.Reactor()
+    completions = [r.completion() for i in range(count)]
+    wakeups = [0]
+    orig_signal = r._got_pipe_signal
+    def got_pipe_signal(eventtime):
+        wakeups[0] += 1
+        orig_signal(eventtime)
+    r._got_pipe_signal = got_pipe_signal
+    def bg_thread():
+        params = {'#sent_time': 0., '#receive_time': 0.}
+        for i in range(0, count, burst):
+            for c in completions[i:i+burst]:
+                r.async_complete(c, params)
+            time.sleep(0.)
+    results = {}
+    def waiter(eventtime):
+        start_time = time.time()
+        thread = threading.Thread(target=bg_thread)
+        thread.start()
+        for c in completions:
+            c.wait()
+        results['duration'] = time.time() - start_time
+        thread.join()
+        r.end()
+    r.register_callback(waiter)
+    r.run()
+    r.finalize()
+    return count / results['duration'], wakeups[0]
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=100000, help="number of completions per test")
+    opts.add_option("-k", "--klippy", type="string", dest="klippy",
+                    default=None, help="klippy directory to benchmark")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    kdir = options.klippy
+    if kdir is None:
+        kdir = os.path.join(os.path.dirname(__file__), '..', 'klippy')
+    sys.path.append(kdir)
+    import reactor
+    print("burst  completions/sec  wakeups")
+    for burst in [1, 10, 100]:
+        rate, wakeups = bench_completions(reactor, options.count, burst)
+        print("%5d  %15.0f  %7d" % (burst, rate, wakeups))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python2
+# Benchmark the g-code parsing and dispatch code
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, time, logging
+
+# Minimal stand-ins for the printer and toolhead classes
+class DummyMutex:
+    def __enter__(self):
+        pass
+    def __exit__(self, type=None, value=None, tb=None):
+        pass
+
+class DummyReactor:
+    def mutex(self):
+        return DummyMutex()
+
+class DummyToolHead:
+    def __init__(self):
+        self.move_count = 0
+    def move(self, newpos, speed):
+        self.move_count += 1
+    def get_position(self):
+        return [0., 0., 0., 0.]
+
+class BenchPrinter:
+    def __init__(self, homing):
+        self.command_error = homing.CommandError
+        self.reactor = DummyReactor()
+        self.objects = {}
+        self.event_handlers = {}
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return self.reactor
+    def get_printer(self):
+        return self
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def invoke_shutdown(self, msg):
+        raise Exception(msg)
+
+def setup_printer():
+    import homing, gcode
+    from extras import gcode_move
+    printer = BenchPrinter(homing)
+    toolhead = DummyToolHead()
+    printer.add_object('toolhead', toolhead)
+    gcode_obj = gcode.GCodeDispatch(printer)
+    printer.add_object('gcode', gcode_obj)
+    # Register the standard move commands and a few common slicer
+    # commands that are not being benchmarked
+    printer.add_object('gcode_move', gcode_move.GCodeMove(printer))
+    for cmd in ['G28', 'M104', 'M106', 'M107', 'M109', 'M140', 'M190',
+                'SET_PRESSURE_ADVANCE', 'SET_VELOCITY_LIMIT']:
+        gcode_obj.register_command(cmd, None)
+        gcode_obj.register_command(cmd, (lambda gcmd: None))
+    printer.send_event("klippy:ready")
+    return printer, gcode_obj, toolhead
+
+# Generate gcode similar to the output of a typical slicer
+def gen_gcode(count):
+    out = ["M107", "M104 S210", "M140 S60", "G28", "G90", "M83",
+           "G1 Z0.300 F600"]
+    layer = 0
+    angle = 0.
+    while len(out) < count:
+        # Perimeter moves
+        out.append(";TYPE:External perimeter")
+        out.append("SET_VELOCITY_LIMIT ACCEL=1500 ACCEL_TO_DECEL=750")
+        for i in range(100):
+            angle += 0.0628
+            out.append("G1 X%.3f Y%.3f E%.5f" % (
+                100. + 50. * math.cos(angle), 100. + 50. * math.sin(angle),
+                0.01047))
+        # Retract, travel, unretract
+        out.append("G1 E-0.80000 F2100")
+        out.append("G0 F9000 X%.3f Y%.3f" % (100. - 40. * math.cos(angle),
+                                             100. - 40. * math.sin(angle)))
+        out.append("G1 E0.80000 F2100")
+        out.append("G1 F1800")
+        # Infill moves
+        out.append(";TYPE:Solid infill")
+        out.append("SET_VELOCITY_LIMIT ACCEL=3000 ACCEL_TO_DECEL=1500")
+        for i in range(50):
+            out.append("G1 X%.3f Y%.3f E%.5f" % (
+                60. + (i & 1) * 80., 60. + i * 1.6, 2.68213))
+        layer += 1
+        if not layer % 4:
+            out.append(";LAYER_CHANGE")
+            out.append("G1 Z%.3f F600" % (.3 + .2 * layer / 4,))
+            out.append("M106 S255")
+            out.append("SET_PRESSURE_ADVANCE ADVANCE=%.3f" % (
+                .02 + .001 * layer / 4,))
+    return out[:count]
+
+def run_bench(gcode_obj, lines, repeat=3):
+    best_duration = None
+    for r in range(repeat):
+        start_time = time.clock()
+        gcode_obj._process_commands(lines, need_ack=False)
+        duration = time.clock() - start_time
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+    return len(lines) / best_duration
+
+def main():
+    usage = "%prog [options] [gcode file]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=100000, help="number of generated gcode lines")
+    opts.add_option("-k", "--klippy", type="string", dest="klippy",
+                    default=None, help="klippy directory to benchmark")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    kdir = options.klippy
+    if kdir is None:
+        kdir = os.path.join(os.path.dirname(__file__), '..', 'klippy')
+    sys.path.append(kdir)
+    logging.basicConfig(level=logging.CRITICAL)
+    if args:
+        f = open(args[0], 'rb')
+        lines = f.read().split('\n')
+        f.close()
+    else:
+        lines = gen_gcode(options.count)
+    printer, gcode_obj, toolhead = setup_printer()
+    move_lines = [l for l in lines
+                  if l.startswith('G1 ') or l.startswith('G0 ')]
+    print("Lines: %d  G0/G1 lines: %d (%.1f%%)" % (
+        len(lines), len(move_lines), 100. * len(move_lines) / len(lines)))
+    print("All lines:   %9.0f lines/sec" % (run_bench(gcode_obj, lines),))
+    print("G0/G1 lines: %9.0f lines/sec" % (run_bench(gcode_obj, move_lines),))
+    ext_lines = [l for l in lines if l.startswith('SET_')]
+    if ext_lines:
+        print("Extended:    %9.0f lines/sec" % (
+            run_bench(gcode_obj, ext_lines),))
+
+if __name__ == '__main__':
+    main()
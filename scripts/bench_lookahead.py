@@ -0,0 +1,129 @@
+#!/usr/bin/env python2
+# Benchmark the toolhead look-ahead planner
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, time
+
+# Default planner limits (similar to a typical cartesian printer)
+MAX_VELOCITY = 300.
+MAX_ACCEL = 3000.
+SQUARE_CORNER_VELOCITY = 5.
+
+class DummyExtruder:
+    def calc_junction(self, prev_move, move):
+        return move.max_cruise_v2
+
+# Minimal stand-in for the ToolHead class - moves are not sent to a trapq
+class BenchToolHead:
+    def __init__(self, toolhead_mod, accel, buffer_time_high):
+        self.toolhead_mod = toolhead_mod
+        self.max_velocity = MAX_VELOCITY
+        self.max_accel = accel
+        self.max_accel_to_decel = accel * .5
+        scv2 = SQUARE_CORNER_VELOCITY**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / accel
+        self.extruder = DummyExtruder()
+        self.move_queue = toolhead_mod.MoveQueue(self)
+        self.move_queue.set_flush_time(buffer_time_high)
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.flush_count = self.flushed_moves = self.queue_depth = 0
+    def _process_moves(self, moves):
+        self.flush_count += 1
+        self.flushed_moves += len(moves)
+        self.queue_depth += len(self.move_queue.queue)
+    def move(self, newpos, speed):
+        move = self.toolhead_mod.Move(self, self.commanded_pos, newpos, speed)
+        if not move.move_d:
+            return
+        self.commanded_pos[:] = move.end_pos
+        self.move_queue.add_move(move)
+
+# Generate a spiral of short segments (similar to arc or mesh split
+# gcode) that alternates between a slow and a fast section
+def gen_moves(count, segment_len, speed):
+    radius = 50.
+    section_len = 50.
+    pos = []
+    angle = dist = 0.
+    for i in range(count):
+        angle += segment_len / radius
+        dist += segment_len
+        move_speed = speed
+        if int(dist / section_len) & 1:
+            move_speed = speed * .05
+        pos.append(([radius * math.cos(angle), radius * math.sin(angle),
+                     0., i * 0.001], move_speed))
+    return pos
+
+def run_bench(toolhead_mod, moves, accel, buffer_time_high, repeat=3):
+    best_duration = None
+    for r in range(repeat):
+        th = BenchToolHead(toolhead_mod, accel, buffer_time_high)
+        start_time = time.clock()
+        for newpos, speed in moves:
+            th.move(newpos, speed)
+        th.move_queue.flush()
+        duration = time.clock() - start_time
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+    avg_depth = 0.
+    if th.flush_count:
+        avg_depth = float(th.queue_depth) / th.flush_count
+    return len(moves) / best_duration, avg_depth
+
+# Report the memory used by a Move (including its containers) and the
+# rate at which Move instances can be created
+def bench_move_alloc(toolhead_mod, moves, repeat=3):
+    th = BenchToolHead(toolhead_mod, MAX_ACCEL, 2.)
+    move = toolhead_mod.Move(th, [0., 0., 0., 0.], [1., 2., 3., 4.], 100.)
+    size = sys.getsizeof(move) + sys.getsizeof(getattr(move, '__dict__', ()))
+    for name in ['start_pos', 'end_pos', 'axes_d', 'axes_r',
+                 'timing_callbacks']:
+        size += sys.getsizeof(getattr(move, name))
+    best_duration = None
+    for r in range(repeat):
+        start_pos = [0., 0., 0., 0.]
+        start_time = time.clock()
+        for newpos, speed in moves:
+            toolhead_mod.Move(th, start_pos, newpos, speed)
+            start_pos = newpos
+        duration = time.clock() - start_time
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+    return size, len(moves) / best_duration
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=20000, help="number of moves per run")
+    opts.add_option("-s", "--speed", type="float", dest="speed",
+                    default=100., help="requested move speed (mm/s)")
+    opts.add_option("-a", "--accel", type="float", dest="accel",
+                    default=MAX_ACCEL, help="max_accel (mm/s^2)")
+    opts.add_option("-k", "--klippy", type="string", dest="klippy",
+                    default=None, help="klippy directory to benchmark")
+    opts.add_option("-b", "--buffer", type="float", dest="buffer",
+                    default=2., help="initial flush time (buffer_time_high)")
+    options, args = opts.parse_args()
+    if len(args) != 0:
+        opts.error("Incorrect number of arguments")
+    kdir = options.klippy
+    if kdir is None:
+        kdir = os.path.join(os.path.dirname(__file__), '..', 'klippy')
+    sys.path.append(kdir)
+    import toolhead
+    moves = gen_moves(options.count, 1., options.speed)
+    size, rate = bench_move_alloc(toolhead, moves)
+    print("Move size: %d bytes  Move creation: %.0f moves/sec" % (size, rate))
+    print("segment_len  queue_depth  moves/sec")
+    for segment_len in [2., 1., .5, .2, .1, .05, .02]:
+        moves = gen_moves(options.count, segment_len, options.speed)
+        rate, depth = run_bench(toolhead, moves, options.accel,
+                                options.buffer)
+        print("%11.3f  %11.0f  %9.0f" % (segment_len, depth, rate))
+
+if __name__ == '__main__':
+    main()
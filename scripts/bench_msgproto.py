@@ -0,0 +1,140 @@
+#!/usr/bin/env python2
+# Check and benchmark the generated msgproto parse/encode functions
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+INT_RANGES = {
+    msgproto.PT_uint32: (0, 0xffffffff),
+    msgproto.PT_int32: (-0x80000000, 0x7fffffff),
+    msgproto.PT_uint16: (0, 0xffff),
+    msgproto.PT_int16: (-0x8000, 0x7fff),
+    msgproto.PT_byte: (0, 0xff),
+}
+
+# Generate a random value for a parameter type
+def random_value(t):
+    if isinstance(t, msgproto.Enumeration):
+        return random.choice(sorted(t.enums.keys()))
+    if t.is_dynamic_string:
+        return ''.join([chr(random.randrange(256))
+                        for i in range(random.randrange(16))])
+    low, high = INT_RANGES[t.__class__]
+    # Favor small values (which use the single byte encoding)
+    if random.randrange(2):
+        return random.randint(max(low, -0x20), min(high, 0x5f))
+    return random.randint(low, high)
+
+def gen_messages(mp, count):
+    out = []
+    for msgid, mf in sorted(mp.messages_by_id.items()):
+        for i in range(count):
+            out.append((mf, [random_value(t) for t in mf.param_types]))
+    return out
+
+# Compare the generated functions with the generic implementation and
+# verify that each message round-trips through encode and parse
+def check_messages(mp, messages):
+    errors = 0
+    for mf, params in messages:
+        if isinstance(mf, msgproto.OutputFormat):
+            data = [mf.msgid]
+            for t, v in zip(mf.param_types, params):
+                t.encode(data, v)
+            generic_parse = msgproto.OutputFormat.parse
+            expected = None
+        else:
+            data = msgproto.MessageFormat.encode(mf, params)
+            by_name = dict(zip([n for n, t in mf.param_names], params))
+            if (mf.encode(params) != data
+                or mf.encode_by_name(**by_name) != data):
+                sys.stderr.write("Encode mismatch: %s %s\n" % (
+                    mf.msgformat, params))
+                errors += 1
+            generic_parse = msgproto.MessageFormat.parse
+            expected = {}
+            for (name, t), v in zip(mf.param_names, params):
+                if isinstance(t, msgproto.Enumeration):
+                    # Enumerations may have several names for a value
+                    v = t.reverse_enums[t.enums[v]]
+                expected[name] = v
+            expected = (expected, len(data))
+        msglen = len(data)
+        data = bytearray(data + [0, 0, 0])
+        res = mf.parse(data, 0)
+        if res != generic_parse(mf, data, 0):
+            sys.stderr.write("Parse mismatch: %s %s\n" % (
+                mf.msgformat, params))
+            errors += 1
+        elif res[1] != msglen or (expected is not None and res != expected):
+            sys.stderr.write("Round-trip mismatch: %s %s %s\n" % (
+                mf.msgformat, params, res))
+            errors += 1
+    return errors
+
+def time_parse(messages, parse_func):
+    best_duration = None
+    for r in range(3):
+        start_time = time.time()
+        for mf, data in messages:
+            parse_func(mf, data, 0)
+        duration = time.time() - start_time
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+    return len(messages) / best_duration
+
+def benchmark(messages):
+    # Benchmark parsing of mcu responses
+    responses = []
+    for mf, params in messages:
+        if isinstance(mf, msgproto.MessageFormat):
+            data = msgproto.MessageFormat.encode(mf, params)
+            responses.append((mf, bytearray(data + [0, 0, 0])))
+    generic_rate = time_parse(responses, (
+        lambda mf, data, pos: msgproto.MessageFormat.parse(mf, data, pos)))
+    gen_rate = time_parse(responses, (
+        lambda mf, data, pos: mf.parse(data, pos)))
+    print("Parse:  generic %9.0f msgs/sec  generated %9.0f msgs/sec" % (
+        generic_rate, gen_rate))
+    generic_rate = time_parse([(mf, params) for mf, params in messages
+                               if isinstance(mf, msgproto.MessageFormat)], (
+        lambda mf, params, pos: msgproto.MessageFormat.encode(mf, params)))
+    gen_rate = time_parse([(mf, params) for mf, params in messages
+                           if isinstance(mf, msgproto.MessageFormat)], (
+        lambda mf, params, pos: mf.encode(params)))
+    print("Encode: generic %9.0f msgs/sec  generated %9.0f msgs/sec" % (
+        generic_rate, gen_rate))
+
+def main():
+    usage = "%prog [options] <mcu data dictionary> [...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=200,
+                    help="number of random messages for each message type")
+    opts.add_option("-c", "--check", action="store_true", dest="check_only",
+                    help="only check the messages (no benchmark)")
+    options, args = opts.parse_args()
+    if not args:
+        opts.error("Incorrect number of arguments")
+    errors = 0
+    for fname in args:
+        mp = msgproto.MessageParser()
+        f = open(fname, 'rb')
+        mp.process_identify(f.read(), decompress=False)
+        f.close()
+        random.seed(0)
+        messages = gen_messages(mp, options.count)
+        dict_errors = check_messages(mp, messages)
+        print("%s: checked %d messages (%d message types): %d errors" % (
+            fname, len(messages), len(mp.messages_by_id), dict_errors))
+        errors += dict_errors
+        if not options.check_only:
+            benchmark(messages)
+    if errors:
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
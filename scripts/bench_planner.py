@@ -0,0 +1,222 @@
+#!/usr/bin/env python2
+# Benchmark host processing by replaying a gcode file without an mcu
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, tempfile, shutil, logging, gc
+
+# Code sections to report (module, class, method, category).  Note that
+# steps are compressed as they are generated - the "step compression"
+# category covers the final compression and queuing in steppersync.
+PROFILE_SECTIONS = [
+    ('gcode', 'GCodeDispatch', '_process_commands', "gcode parsing"),
+    ('toolhead', 'MoveQueue', 'flush', "lookahead"),
+    ('toolhead', 'ToolHead', '_process_moves', "move queuing"),
+    ('stepper', 'MCU_stepper', 'generate_steps', "step generation"),
+    ('mcu', 'MCU', 'flush_moves', "step compression"),
+]
+
+
+######################################################################
+# Code section timing
+######################################################################
+
+# Track the time spent in each category (excluding nested categories)
+class Profiler:
+    def __init__(self):
+        self.totals = {}
+        self.stack = []
+        self.counts = {}
+    def wrap(self, cls, method_name, category):
+        orig = getattr(cls, method_name)
+        totals = self.totals
+        stack = self.stack
+        totals[category] = 0.
+        def wrapper(*args, **kwargs):
+            curtime = time.time()
+            if stack:
+                top = stack[-1]
+                totals[top[0]] += curtime - top[1]
+            stack.append([category, curtime])
+            try:
+                return orig(*args, **kwargs)
+            finally:
+                curtime = time.time()
+                cat, start_time = stack.pop()
+                totals[cat] += curtime - start_time
+                if stack:
+                    stack[-1][1] = curtime
+        setattr(cls, method_name, wrapper)
+    def note_calls(self, cls, method_name, callback):
+        orig = getattr(cls, method_name)
+        def wrapper(*args, **kwargs):
+            callback(*args, **kwargs)
+            return orig(*args, **kwargs)
+        setattr(cls, method_name, wrapper)
+    def add_count(self, name, count=1):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+def setup_profiler():
+    import gcode, toolhead, stepper
+    profiler = Profiler()
+    for mod_name, cls_name, method_name, category in PROFILE_SECTIONS:
+        cls = getattr(__import__(mod_name), cls_name)
+        profiler.wrap(cls, method_name, category)
+    # Track number of gcode lines, number of moves, and active steppers
+    steppers = []
+    def note_lines(gcode, commands, need_ack=True):
+        profiler.add_count('lines', len(commands))
+    def note_move(move_queue, move):
+        profiler.add_count('moves')
+    def note_stepper(stepper, flush_time, **kwargs):
+        if stepper not in steppers:
+            steppers.append(stepper)
+    profiler.note_calls(gcode.GCodeDispatch, '_process_commands', note_lines)
+    profiler.note_calls(toolhead.MoveQueue, 'add_move', note_move)
+    profiler.note_calls(stepper.MCU_stepper, 'generate_steps', note_stepper)
+    return profiler, steppers
+
+
+######################################################################
+# Step counting
+######################################################################
+
+# Count the steps in each queue_step message of an mcu output file
+def count_steps(msgproto, dict_fname, out_fname):
+    mp = msgproto.MessageParser()
+    f = open(dict_fname, 'rb')
+    mp.process_identify(f.read(), decompress=False)
+    f.close()
+    f = open(out_fname, 'rb')
+    data = bytearray(f.read())
+    f.close()
+    step_counts = {}
+    offset = 0
+    while offset < len(data):
+        l = mp.check_packet(data, offset)
+        if l <= 0:
+            # Truncated or invalid data at end of file
+            break
+        s = data[offset:offset+l]
+        offset += l
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id.get(s[pos], mp.unknown)
+            params, pos = mid.parse(s, pos)
+            if mid.name == 'queue_step':
+                oid = params['oid']
+                step_counts[oid] = step_counts.get(oid, 0) + params['count']
+    return step_counts
+
+
+######################################################################
+# Startup
+######################################################################
+
+def arg_dictionary(option, opt_str, value, parser):
+    key, fname = "dictionary", value
+    if '=' in value:
+        mcu_name, fname = value.split('=', 1)
+        key = "dictionary_" + mcu_name
+    if parser.values.dictionary is None:
+        parser.values.dictionary = {}
+    parser.values.dictionary[key] = fname
+
+def run_bench(klippy, reactor, start_args):
+    gc.disable()
+    gc.collect()
+    main_reactor = reactor.Reactor(gc_checking=True)
+    printer = klippy.Printer(main_reactor, None, start_args)
+    start_time = time.time()
+    res = printer.run()
+    duration = time.time() - start_time
+    return printer, res, duration
+
+def main():
+    usage = "%prog [options] <config file> <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictionary", dest="dictionary", type="string",
+                    action="callback", callback=arg_dictionary,
+                    help="file to read for mcu protocol dictionary")
+    opts.add_option("-k", "--klippy", type="string", dest="klippy",
+                    default=None, help="klippy directory to benchmark")
+    opts.add_option("-l", "--logfile", dest="logfile",
+                    help="write klippy log to file (default is to discard)")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    if not options.dictionary:
+        opts.error("Must specify an mcu dictionary file (-d)")
+    config_fname, gcode_fname = args
+    kdir = options.klippy
+    if kdir is None:
+        kdir = os.path.join(os.path.dirname(__file__), '..', 'klippy')
+    sys.path.append(kdir)
+    # Setup logging
+    if options.logfile:
+        logging.basicConfig(level=logging.INFO, filename=options.logfile)
+    else:
+        logging.basicConfig(level=logging.CRITICAL)
+    # Import klippy code and add timing hooks
+    import klippy, reactor, msgproto, util
+    profiler, steppers = setup_profiler()
+    # Run the gcode file
+    tmpdir = tempfile.mkdtemp(prefix="bench_planner")
+    try:
+        out_fname = os.path.join(tmpdir, "output")
+        debuginput = open(gcode_fname, 'rb')
+        start_args = {'config_file': config_fname, 'apiserver': None,
+                      'start_reason': 'startup', 'debuginput': gcode_fname,
+                      'gcode_fd': debuginput.fileno(),
+                      'debugoutput': out_fname,
+                      'software_version': util.get_git_version(),
+                      'cpu_info': util.get_cpu_info()}
+        start_args.update(options.dictionary)
+        printer, res, duration = run_bench(klippy, reactor, start_args)
+        if res != 'exit':
+            sys.stderr.write("Error running gcode file (%s)\n" % (res,))
+            sys.exit(-1)
+        # Count the steps generated for each stepper
+        step_counts = {}
+        for mcu_name, mcu in printer.lookup_objects(module='mcu'):
+            dict_key = 'dictionary'
+            mcu_out_fname = out_fname
+            if mcu_name != 'mcu':
+                mcu_name = mcu_name[4:]
+                dict_key = 'dictionary_' + mcu_name
+                mcu_out_fname = out_fname + "-" + mcu_name
+            counts = count_steps(msgproto, start_args[dict_key],
+                                 mcu_out_fname)
+            for oid, count in counts.items():
+                step_counts[(mcu, oid)] = count
+    finally:
+        shutil.rmtree(tmpdir)
+    # Report results
+    toolhead = printer.lookup_object('toolhead')
+    print_time = toolhead.get_last_move_time()
+    counts = profiler.counts
+    print("Run time: %.3fs  Print time: %.3fs  (%.1fx realtime)" % (
+        duration, print_time, print_time / duration))
+    for name in ['lines', 'moves']:
+        count = counts.get(name, 0)
+        print("%-8s %10d  %12.0f/sec" % (name + ":", count, count / duration))
+    width = max([18] + [len(s.get_name()) for s in steppers])
+    print("%-*s %10s  %12s" % (width, "stepper", "steps", "steps/sec"))
+    for stepper in sorted(steppers, key=lambda s: s.get_name()):
+        count = step_counts.get((stepper.get_mcu(), stepper.get_oid()), 0)
+        print("%-*s %10d  %12.0f" % (width, stepper.get_name(), count,
+                                     count / duration))
+    print("section                  time    percent")
+    totals = profiler.totals
+    other_time = duration
+    for mod_name, cls_name, method_name, category in PROFILE_SECTIONS:
+        section_time = totals[category]
+        other_time -= section_time
+        print("%-18s %9.3fs %9.1f%%" % (category, section_time,
+                                        100. * section_time / duration))
+    print("%-18s %9.3fs %9.1f%%" % ("other", other_time,
+                                    100. * other_time / duration))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python2
+# Benchmark the reactor timer handling
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+
+# Time the wakeup of a timer that reschedules itself while 'num_timers'
+# other timers are registered (but not yet due)
+def bench_wakeup(reactor, num_timers, count):
+    r = reactor.Reactor()
+    curtime = r.monotonic()
+    for i in range(num_timers):
+        r.register_timer((lambda e: e + 1000.), curtime + 1000. + i)
+    state = {'count': 0}
+    def wakeup(eventtime):
+        state['count'] += 1
+        if state['count'] >= count:
+            r.end()
+            return r.NEVER
+        return r.NOW
+    r.register_timer(wakeup, r.NOW)
+    start_time = time.time()
+    r.run()
+    duration = time.time() - start_time
+    r.finalize()
+    return duration / count
+
+# Time reactor.pause() calls (each pause registers a new timer)
+def bench_pause(reactor, num_timers, count):
+    r = reactor.Reactor()
+    curtime = r.monotonic()
+    for i in range(num_timers):
+        r.register_timer((lambda e: e + 1000.), curtime + 1000. + i)
+    def pause_loop(eventtime):
+        for i in range(count):
+            r.pause(r.NOW)
+        r.end()
+    r.register_callback(pause_loop)
+    start_time = time.time()
+    r.run()
+    duration = time.time() - start_time
+    r.finalize()
+    return duration / count
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=50000, help="number of wakeups per test")
+    opts.add_option("-k", "--klippy", type="string", dest="klippy",
+                    default=None, help="klippy directory to benchmark")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    kdir = options.klippy
+    if kdir is None:
+        kdir = os.path.join(os.path.dirname(__file__), '..', 'klippy')
+    sys.path.append(kdir)
+    import reactor
+    print("timers  wakeup (usec)  pause (usec)")
+    for num_timers in [10, 100, 1000]:
+        wakeup_time = bench_wakeup(reactor, num_timers, options.count)
+        pause_time = bench_pause(reactor, num_timers, options.count)
+        print("%6d  %13.2f  %12.2f" % (num_timers, wakeup_time * 1000000.,
+                                       pause_time * 1000000.))
+
+if __name__ == '__main__':
+    main()
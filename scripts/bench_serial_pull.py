@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+# Benchmark SerialReader processing of mcu responses
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, threading, socket
+
+RESPONSE = "analog_in_state oid=%c next_clock=%u value=%hu"
+
+# Generate framed mcu responses (all using the initial sequence number)
+def gen_data(msgproto, mp, count):
+    mf = mp.lookup_command(RESPONSE)
+    out = bytearray()
+    for i in range(count):
+        cmd = mf.encode([i & 0x0f, (i * 12345) & 0xffffffff, i & 0xffff])
+        mp.encode_into(out, 1, cmd)
+    return str(out)
+
+# Feed 'data' to a SerialReader background thread and time how long
+# it takes to dispatch all the responses
+def bench_pull(serialhdl, msgproto, reactor, dict_data, count):
+    mp = msgproto.MessageParser()
+    mp.process_identify(dict_data, decompress=False)
+    data = gen_data(msgproto, mp, count)
+    r = reactor.Reactor()
+    sr = serialhdl.SerialReader(r, "bench", 0)
+    sr.msgparser = mp
+    done = threading.Event()
+    state = {'count': 0}
+    def handle_analog_in_state(params):
+        state['count'] += 1
+        if state['count'] >= count:
+            done.set()
+    for oid in range(16):
+        sr.register_response(handle_analog_in_state, 'analog_in_state', oid)
+    host_sock, mcu_sock = socket.socketpair()
+    sr.serialqueue = sr.ffi_main.gc(
+        sr.ffi_lib.serialqueue_alloc(host_sock.fileno(), 0),
+        sr.ffi_lib.serialqueue_free)
+    sr.background_thread = threading.Thread(target=sr._bg_thread)
+    sr.background_thread.start()
+    start_time = time.time()
+    mcu_sock.sendall(data)
+    done.wait(60.)
+    duration = time.time() - start_time
+    stats = dict([kv.split('=', 1) for kv in sr.stats(0.).split()])
+    sr.disconnect()
+    mcu_sock.close()
+    r.finalize()
+    return state['count'] / duration, stats
+
+def main():
+    usage = "%prog [options] <mcu data dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=200000, help="number of responses per test")
+    opts.add_option("-k", "--klippy", type="string", dest="klippy",
+                    default=None, help="klippy directory to benchmark")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    kdir = options.klippy
+    if kdir is None:
+        kdir = os.path.join(os.path.dirname(__file__), '..', 'klippy')
+    f = open(args[0], 'rb')
+    dict_data = f.read()
+    f.close()
+    sys.path.append(kdir)
+    import serialhdl, msgproto, reactor
+    for i in range(5):
+        rate, stats = bench_pull(serialhdl, msgproto, reactor, dict_data,
+                                 options.count)
+        print("%9.0f responses/sec  thread_cpu=%s reader_cpu=%s" % (
+            rate, stats.get('thread_cpu', '?'), stats.get('reader_cpu', '?')))
+
+if __name__ == '__main__':
+    main()
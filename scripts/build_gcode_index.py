@@ -0,0 +1,39 @@
+#!/usr/bin/env python2
+# Build the layer and progress index used by virtual_sdcard
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import gcode_index
+
+def main():
+    usage = "%prog [options] <gcode file> [<gcode file> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-v", "--velocity", type="float", dest="velocity",
+                    default=gcode_index.DEFAULT_VELOCITY,
+                    help="printer max_velocity used for time estimates")
+    opts.add_option("-a", "--accel", type="float", dest="accel",
+                    default=gcode_index.DEFAULT_ACCEL,
+                    help="printer max_accel used for time estimates")
+    opts.add_option("-s", "--scv", type="float", dest="scv",
+                    default=gcode_index.DEFAULT_SQUARE_CORNER_VELOCITY,
+                    help="printer square_corner_velocity used for time"
+                    " estimates")
+    options, args = opts.parse_args()
+    if not args:
+        opts.error("Incorrect number of arguments")
+    for fname in args:
+        start_time = time.time()
+        gcode_index.build_index(fname, options.velocity, options.accel,
+                                options.scv)
+        index = gcode_index.load_index(fname)
+        print("Wrote %s (%d lines, %d layers, %.0fs estimated, %.1fmm"
+              " filament) in %.3fs" % (
+                  gcode_index.get_index_filename(fname), index.line_count,
+                  len(index.layers), index.total_time, index.total_filament,
+                  time.time() - start_time))
+
+if __name__ == '__main__':
+    main()
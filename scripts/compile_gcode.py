@@ -0,0 +1,34 @@
+#!/usr/bin/env python2
+# Convert a g-code file into the binary format used by virtual_sdcard
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import gcode_binary
+
+def main():
+    usage = "%prog [options] <input gcode file> [<output file>]"
+    opts = optparse.OptionParser(usage)
+    options, args = opts.parse_args()
+    if len(args) not in (1, 2):
+        opts.error("Incorrect number of arguments")
+    in_fname = args[0]
+    if len(args) == 2:
+        out_fname = args[1]
+    else:
+        out_fname = "%s.%s" % (os.path.splitext(in_fname)[0],
+                               gcode_binary.FILE_EXT)
+    infile = open(in_fname, 'rb')
+    outfile = open(out_fname, 'wb')
+    gcode_binary.compile_file(infile, outfile)
+    in_size = infile.tell()
+    out_size = outfile.tell()
+    infile.close()
+    outfile.close()
+    print("Wrote %s (%d bytes, %.1f%% of original)" % (
+        out_fname, out_size, 100. * out_size / max(in_size, 1)))
+
+if __name__ == '__main__':
+    main()
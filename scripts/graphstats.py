@@ -4,7 +4,7 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import optparse, datetime
+import optparse, datetime, json
 import matplotlib
 
 MAXBANDWIDTH=25000.
@@ -18,6 +18,22 @@ APPLY_PREFIX = [
     'target', 'temp', 'pwm'
 ]
 
+def parse_json_stats(sample, mcu, apply_prefix):
+    keyparts = {}
+    for name, val in sample.items():
+        if not isinstance(val, dict):
+            keyparts[str(name)] = val
+            continue
+        prefix = str(name) + ':'
+        if name == mcu:
+            prefix = ''
+        for subname, subval in val.items():
+            subname = str(subname)
+            if subname in apply_prefix:
+                subname = prefix + subname
+            keyparts[subname] = subval
+    return keyparts
+
 def parse_log(logname, mcu):
     if mcu is None:
         mcu = "mcu"
@@ -26,6 +42,16 @@ def parse_log(logname, mcu):
     f = open(logname, 'rb')
     out = []
     for line in f:
+        if line.startswith('{'):
+            # Line from a [statistics] output file
+            try:
+                sample = json.loads(line)
+            except ValueError:
+                continue
+            keyparts = parse_json_stats(sample, mcu, apply_prefix)
+            if 'print_time' in keyparts:
+                out.append(keyparts)
+            continue
         parts = line.split()
         if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
             #if parts and parts[0] == 'INFO:root:shutdown:':
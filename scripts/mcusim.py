@@ -0,0 +1,502 @@
+#!/usr/bin/env python2
+# Simulate a micro-controller on a pseudo-tty for host-only testing
+#
+# Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, zlib, select, collections, errno
+import pty, fcntl, termios
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+# Commands that are still processed after a shutdown
+SHUTDOWN_COMMANDS = {
+    'identify': 1, 'get_uptime': 1, 'get_clock': 1, 'get_config': 1,
+    'emergency_stop': 1, 'clear_shutdown': 1, 'config_reset': 1,
+    'reset': 1, 'debug_ping': 1, 'debug_nop': 1,
+}
+STATS_INTERVAL = 5.
+STATS_LOAD = .01
+STATS_SUMSQ_BASE = 256
+
+
+######################################################################
+# Simulated mcu objects
+######################################################################
+
+class SimStepper:
+    def __init__(self, mcu, params):
+        self.mcu = mcu
+        self.next_dir = 0
+        self.need_reset = False
+        # Pending moves (interval, count, add, dir) and the active move
+        self.moves = collections.deque()
+        self.active = None
+        # Clock of the last step of the active move
+        self.next_step_time = 0
+        # Position after all steps of the active move are taken
+        self.position = 0
+    def _load_next(self):
+        interval, count, add, sdir = self.moves.popleft()
+        self.mcu.free_move()
+        start = self.next_step_time
+        self.next_step_time = (start + count * interval
+                               + add * count * (count - 1) // 2)
+        self.active = (start, interval, count, add, sdir)
+        if sdir:
+            self.position += count
+        else:
+            self.position -= count
+        return start + interval
+    def update(self, clock):
+        # Load queued moves once the previous move has completed
+        while self.active is not None and self.next_step_time <= clock:
+            self.active = None
+            if self.moves:
+                self._load_next()
+    def _steps_remaining(self, clock):
+        start, interval, count, add, sdir = self.active
+        low, high = 0, count
+        while low < high:
+            k = (low + high + 1) // 2
+            if start + k * interval + add * k * (k - 1) // 2 <= clock:
+                low = k
+            else:
+                high = k - 1
+        return count - low
+    def get_position(self, clock):
+        self.update(clock)
+        if self.active is None:
+            return self.position
+        remaining = self._steps_remaining(clock)
+        if self.active[4]:
+            return self.position - remaining
+        return self.position + remaining
+    def stop(self, clock):
+        self.position = self.get_position(clock)
+        for m in self.moves:
+            self.mcu.free_move()
+        self.moves.clear()
+        self.active = None
+        self.next_step_time = 0
+        self.need_reset = True
+    def queue_step(self, clock, interval, count, add):
+        if not count:
+            self.mcu.shutdown("Invalid count parameter")
+            return
+        if not self.mcu.alloc_move():
+            return
+        if self.need_reset:
+            self.mcu.free_move()
+            return
+        self.moves.append((interval, count, add, self.next_dir))
+        if self.active is None:
+            first_step = self._load_next()
+            if first_step < clock:
+                self.mcu.shutdown("Timer too close")
+    def reset_step_clock(self, clock, step_clock):
+        self.update(clock)
+        if self.active is not None:
+            self.mcu.shutdown("Can't reset time when stepper active")
+            return
+        self.next_step_time = step_clock
+        self.need_reset = False
+
+class SimEndstop:
+    def __init__(self, mcu, params):
+        self.mcu = mcu
+        self.oid = params['oid']
+        self.steppers = [None] * params['stepper_count']
+        self.homing = False
+        self.trigger_clock = None
+        self.pin_value = 0
+    def get_next_event(self):
+        return self.trigger_clock
+    def handle_event(self, clock):
+        # Report the endstop as triggered and stop its steppers
+        self.trigger_clock = None
+        self.homing = False
+        for s in self.steppers:
+            if s is not None:
+                s.stop(clock)
+        self.mcu.send("endstop_state oid=%c homing=%c pin_value=%c",
+                      self.oid, 0, self.pin_value)
+    def home(self, clock, sample_count, pin_value):
+        if not sample_count:
+            self.homing = False
+            self.trigger_clock = None
+            return
+        self.homing = True
+        self.pin_value = pin_value
+        self.trigger_clock = clock + self.mcu.endstop_delay_ticks
+    def query_state(self):
+        pin_value = 0
+        if self.homing:
+            pin_value = not self.pin_value
+        self.mcu.send("endstop_state oid=%c homing=%c pin_value=%c",
+                      self.oid, self.homing, pin_value)
+    def stop(self):
+        self.homing = False
+        self.trigger_clock = None
+
+class SimAnalogIn:
+    def __init__(self, mcu, params):
+        self.mcu = mcu
+        self.oid = params['oid']
+        self.report_clock = None
+        self.next_begin_time = self.rest_ticks = 0
+        self.sample_ticks = self.sample_count = 0
+        self.min_value = self.max_value = 0
+        self.range_check_count = self.invalid_count = 0
+    def get_next_event(self):
+        return self.report_clock
+    def handle_event(self, clock):
+        value = int(self.mcu.adc_value * self.sample_count)
+        if self.min_value <= value <= self.max_value:
+            self.invalid_count = 0
+        else:
+            self.invalid_count += 1
+            if self.invalid_count >= self.range_check_count:
+                self.invalid_count = 0
+                self.mcu.shutdown("ADC out of range")
+                return
+        self.next_begin_time += self.rest_ticks
+        self.report_clock = (self.next_begin_time
+                             + (self.sample_count - 1) * self.sample_ticks)
+        self.mcu.send("analog_in_state oid=%c next_clock=%u value=%hu",
+                      self.oid, self.next_begin_time & 0xffffffff, value)
+    def query(self, clock, params):
+        self.next_begin_time = clock
+        self.sample_ticks = params['sample_ticks']
+        self.sample_count = params['sample_count']
+        self.rest_ticks = params['rest_ticks']
+        self.min_value = params['min_value']
+        self.max_value = params['max_value']
+        self.range_check_count = params['range_check_count']
+        self.report_clock = None
+        if self.sample_count:
+            self.report_clock = clock + (self.sample_count-1)*self.sample_ticks
+    def stop(self):
+        self.report_clock = None
+
+
+######################################################################
+# Simulated mcu
+######################################################################
+
+class MCUSim:
+    def __init__(self, fd, dict_data, options):
+        self.fd = fd
+        self.mp = msgproto.MessageParser()
+        self.mp.process_identify(dict_data, decompress=False)
+        self.identify_data = zlib.compress(dict_data)
+        self.static_strings = self.mp.get_enumerations().get(
+            'static_string_id', {})
+        self.formats = {}
+        # Clock simulation
+        self.freq = self.mp.get_constant_float('CLOCK_FREQ')
+        self.clock_rate = self.freq * (1. + options.drift * .000001)
+        self.start_time = time.time()
+        self.endstop_delay_ticks = int(options.endstop_delay * self.freq)
+        adc_max = self.mp.get_constant_float('ADC_MAX', 1023.)
+        self.adc_value = int(options.adc * adc_max)
+        self.move_count = options.move_count
+        # Serial transmit pacing
+        self.baud = options.baud
+        if self.baud is None:
+            self.baud = self.mp.get_constant_int('SERIAL_BAUD', 0)
+        self.tx_queue = collections.deque()
+        self.tx_time = 0.
+        self.stats_time = self.start_time + STATS_INTERVAL
+        self.reset()
+    def reset(self):
+        self.next_sequence = msgproto.MESSAGE_DEST
+        self.input = bytearray()
+        self.config_reset()
+    def config_reset(self):
+        self.oids = {}
+        self.is_config = self.crc = 0
+        self.moves_free = self.move_count
+        self.shutdown_reason = None
+    # Clock helpers
+    def get_clock(self, eventtime):
+        return int((eventtime - self.start_time) * self.clock_rate)
+    def clock_to_time(self, clock):
+        return self.start_time + clock / self.clock_rate
+    def clock32_to_64(self, clock32):
+        clock = self.get_clock(time.time())
+        diff = (clock32 - clock) & 0xffffffff
+        if diff & 0x80000000:
+            diff -= 0x100000000
+        return clock + diff
+    # Move queue
+    def alloc_move(self):
+        if not self.moves_free:
+            self.shutdown("Move queue empty")
+            return False
+        self.moves_free -= 1
+        return True
+    def free_move(self):
+        self.moves_free += 1
+    # Message transmit
+    def send(self, msgformat, *params):
+        mf = self.formats.get(msgformat)
+        if mf is None:
+            mf = self.formats[msgformat] = self.mp.lookup_command(msgformat)
+        self._write(self.mp.encode(self.next_sequence, mf.encode(params)))
+    def _write(self, data):
+        if not self.baud:
+            self._write_pty(data)
+            return
+        eventtime = time.time()
+        self.tx_time = max(eventtime, self.tx_time) + len(data) * 10./self.baud
+        self.tx_queue.append((self.tx_time, data))
+    def _write_pty(self, data):
+        try:
+            os.write(self.fd, data)
+        except os.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+    def _send_acknak(self):
+        self._write(self.mp.encode(self.next_sequence, []))
+    # Shutdown handling
+    def shutdown(self, reason):
+        if self.shutdown_reason is not None:
+            return
+        if reason not in self.static_strings:
+            reason = "Command request"
+        self.shutdown_reason = reason
+        clock = self.get_clock(time.time())
+        for obj in self.oids.values():
+            if isinstance(obj, SimStepper):
+                obj.stop(clock)
+            elif isinstance(obj, (SimEndstop, SimAnalogIn)):
+                obj.stop()
+        self.send("shutdown clock=%u static_string_id=%hu",
+                  clock & 0xffffffff, reason)
+    # Message receive
+    def _process_input(self, data):
+        self.input.extend(data)
+        while self.input:
+            msglen = self.mp.check_packet(self.input)
+            if not msglen:
+                break
+            if msglen < 0:
+                if self.input[0] != msgproto.MESSAGE_SYNC_BYTE:
+                    self._send_acknak()
+                del self.input[:-msglen]
+                continue
+            seq = self.input[msgproto.MESSAGE_POS_SEQ]
+            if seq != self.next_sequence:
+                # Lost message - discard until it is retransmitted
+                self._send_acknak()
+            else:
+                self.next_sequence = (
+                    ((seq + 1) & msgproto.MESSAGE_SEQ_MASK)
+                    | msgproto.MESSAGE_DEST)
+                if self._dispatch(msglen):
+                    self._send_acknak()
+            del self.input[:msglen]
+    def _dispatch(self, msglen):
+        clock = self.get_clock(time.time())
+        for obj in self.oids.values():
+            if isinstance(obj, SimStepper):
+                obj.update(clock)
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        end = msglen - msgproto.MESSAGE_TRAILER_SIZE
+        while pos < end:
+            mf = self.mp.messages_by_id.get(self.input[pos])
+            if mf is None:
+                self.shutdown("Invalid command")
+                return True
+            params, pos = mf.parse(self.input, pos)
+            if (self.shutdown_reason is not None
+                and mf.name not in SHUTDOWN_COMMANDS):
+                self.send("is_shutdown static_string_id=%hu",
+                          self.shutdown_reason)
+                continue
+            func = getattr(self, 'cmd_' + mf.name, None)
+            if func is not None and func(params, clock):
+                # mcu reset - no ack is sent
+                return False
+        return True
+    # Periodic events
+    def _process_events(self, eventtime):
+        clock = self.get_clock(eventtime)
+        next_clock = None
+        for obj in self.oids.values():
+            if isinstance(obj, SimStepper):
+                continue
+            event_clock = obj.get_next_event()
+            while event_clock is not None and event_clock <= clock:
+                obj.handle_event(clock)
+                event_clock = obj.get_next_event()
+            if event_clock is not None and (next_clock is None
+                                            or event_clock < next_clock):
+                next_clock = event_clock
+        if eventtime >= self.stats_time:
+            self.stats_time = eventtime + STATS_INTERVAL
+            count = 1000
+            ticks = int(self.freq * STATS_INTERVAL * STATS_LOAD / count)
+            sumsq = count * ((ticks * ticks + STATS_SUMSQ_BASE - 1)
+                             // STATS_SUMSQ_BASE)
+            self.send("stats count=%u sum=%u sumsq=%u", count,
+                      count * ticks, min(sumsq, 0xffffffff))
+        while self.tx_queue and self.tx_queue[0][0] <= eventtime:
+            self._write_pty(self.tx_queue.popleft()[1])
+        waketime = self.stats_time
+        if next_clock is not None:
+            waketime = min(waketime, self.clock_to_time(next_clock))
+        if self.tx_queue:
+            waketime = min(waketime, self.tx_queue[0][0])
+        return waketime
+    def run(self):
+        while 1:
+            waketime = self._process_events(time.time())
+            timeout = max(0., waketime - time.time())
+            res = select.select([self.fd], [], [], timeout)
+            if not res[0]:
+                continue
+            try:
+                data = os.read(self.fd, 4096)
+            except os.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                continue
+            self._process_input(data)
+    # Basic commands
+    def cmd_identify(self, params, clock):
+        offset = params['offset']
+        data = self.identify_data[offset:offset+params['count']]
+        self.send("identify_response offset=%u data=%.*s", offset, data)
+    def cmd_get_uptime(self, params, clock):
+        self.send("uptime high=%u clock=%u", clock >> 32, clock & 0xffffffff)
+    def cmd_get_clock(self, params, clock):
+        self.send("clock clock=%u", clock & 0xffffffff)
+    def cmd_get_config(self, params, clock):
+        self.send("config is_config=%c crc=%u move_count=%hu is_shutdown=%c",
+                  self.is_config, self.crc, self.move_count,
+                  self.shutdown_reason is not None)
+    def cmd_finalize_config(self, params, clock):
+        if self.is_config:
+            self.shutdown("Already finalized")
+            return
+        self.is_config = 1
+        self.crc = params['crc']
+    def cmd_emergency_stop(self, params, clock):
+        self.shutdown("Command request")
+    def cmd_clear_shutdown(self, params, clock):
+        if self.shutdown_reason is None:
+            self.shutdown("Shutdown cleared when not shutdown")
+            return
+        self.shutdown_reason = None
+    def cmd_config_reset(self, params, clock):
+        if self.shutdown_reason is None:
+            self.shutdown("config_reset only available when shutdown")
+            return
+        self.config_reset()
+    def cmd_reset(self, params, clock):
+        self.reset()
+        return True
+    def cmd_debug_ping(self, params, clock):
+        self.send("pong data=%*s", params['data'])
+    # Steppers
+    def cmd_config_stepper(self, params, clock):
+        self.oids[params['oid']] = SimStepper(self, params)
+    def cmd_queue_step(self, params, clock):
+        self.oids[params['oid']].queue_step(
+            clock, params['interval'], params['count'], params['add'])
+    def cmd_set_next_step_dir(self, params, clock):
+        self.oids[params['oid']].next_dir = params['dir']
+    def cmd_reset_step_clock(self, params, clock):
+        self.oids[params['oid']].reset_step_clock(
+            clock, self.clock32_to_64(params['clock']))
+    def cmd_stepper_get_position(self, params, clock):
+        pos = self.oids[params['oid']].get_position(clock)
+        self.send("stepper_position oid=%c pos=%i", params['oid'], pos)
+    # Endstops
+    def cmd_config_endstop(self, params, clock):
+        self.oids[params['oid']] = SimEndstop(self, params)
+    def cmd_endstop_set_stepper(self, params, clock):
+        e = self.oids[params['oid']]
+        e.steppers[params['pos']] = self.oids[params['stepper_oid']]
+    def cmd_endstop_home(self, params, clock):
+        self.oids[params['oid']].home(self.clock32_to_64(params['clock']),
+                                      params['sample_count'],
+                                      params['pin_value'])
+    def cmd_endstop_query_state(self, params, clock):
+        self.oids[params['oid']].query_state()
+    # Analog inputs
+    def cmd_config_analog_in(self, params, clock):
+        self.oids[params['oid']] = SimAnalogIn(self, params)
+    def cmd_query_analog_in(self, params, clock):
+        self.oids[params['oid']].query(self.clock32_to_64(params['clock']),
+                                       params)
+
+
+######################################################################
+# Startup
+######################################################################
+
+# Support for creating a pseudo-tty for emulating a serial port
+def create_pty(ptyname):
+    mfd, sfd = pty.openpty()
+    try:
+        os.unlink(ptyname)
+    except os.error:
+        pass
+    os.symlink(os.ttyname(sfd), ptyname)
+    fcntl.fcntl(mfd, fcntl.F_SETFL
+                , fcntl.fcntl(mfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    tcattr = termios.tcgetattr(mfd)
+    tcattr[0] &= ~(
+        termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP |
+        termios.INLCR | termios.IGNCR | termios.ICRNL | termios.IXON)
+    tcattr[1] &= ~termios.OPOST
+    tcattr[3] &= ~(
+        termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG |
+        termios.IEXTEN)
+    tcattr[2] &= ~(termios.CSIZE | termios.PARENB)
+    tcattr[2] |= termios.CS8
+    tcattr[6][termios.VMIN] = 0
+    tcattr[6][termios.VTIME] = 0
+    termios.tcsetattr(mfd, termios.TCSAFLUSH, tcattr)
+    return mfd, sfd
+
+def main():
+    usage = "%prog [options] <mcu data dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-p", "--port", type="string", dest="port",
+                    default="/tmp/pseudoserial",
+                    help="pseudo-tty device to create for serial port")
+    opts.add_option("-b", "--baud", type="int", dest="baud", default=None,
+                    help="transmit baud rate (default is SERIAL_BAUD from"
+                    " the dictionary)")
+    opts.add_option("--drift", type="float", dest="drift", default=50.,
+                    help="mcu clock drift in parts per million")
+    opts.add_option("--move-count", type="int", dest="move_count",
+                    default=500, help="number of entries in the move queue")
+    opts.add_option("--adc", type="float", dest="adc", default=.95,
+                    help="analog input value as a fraction of ADC_MAX")
+    opts.add_option("--endstop-delay", type="float", dest="endstop_delay",
+                    default=.1, help="time from start of homing to trigger")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    f = open(args[0], 'rb')
+    dict_data = f.read()
+    f.close()
+    mfd, sfd = create_pty(options.port)
+    sim = MCUSim(mfd, dict_data, options)
+    sys.stdout.write("Starting mcu simulation: mcu=%s freq=%d drift=%.1fppm\n"
+                     "Serial: port=%s baud=%d\n" % (
+                         sim.mp.get_constant('MCU'), sim.freq, options.drift,
+                         options.port, sim.baud))
+    sys.stdout.flush()
+    try:
+        sim.run()
+    finally:
+        os.unlink(options.port)
+
+if __name__ == '__main__':
+    main()
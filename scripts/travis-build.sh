@@ -67,6 +67,10 @@ done
 HOSTDIR=${BUILD_DIR}/hosttest
 mkdir -p ${HOSTDIR}
 
+start_test msgproto "Check message encoding"
+$PYTHON scripts/bench_msgproto.py -c ${DICTDIR}/*.dict
+finish_test msgproto "Check message encoding"
+
 start_test klippy "Test invoke klippy"
 $PYTHON scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy"
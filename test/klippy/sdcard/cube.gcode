@@ -0,0 +1,58 @@
+; Small three layer test print
+G90
+M83
+G92 E0
+G1 Z0.3 F300
+G1 X20 Y20 F6000
+;LAYER:0
+G1 X40 Y20 E0.8 F1800
+G1 X40.975 Y20.096 E0.05
+G1 X41.913 Y20.381 E0.05
+G1 X42.778 Y20.843 E0.05
+G1 X43.536 Y21.464 E0.05
+G1 X44.157 Y22.222 E0.05
+G1 X44.619 Y23.087 E0.05
+G1 X44.904 Y24.025 E0.05
+G1 X45.000 Y25.000 E0.05
+G1 X45 Y40 E0.6
+G1 X20 Y40 E1.0
+G1 X20 Y20 E0.8 ; close
+G1 E-1 F2100
+G1 X22 Y22 F6000
+G1 E1 F2100
+G1 Z0.5 F300
+;LAYER:1
+G1 X40 Y20 E0.8 F1800
+G1 X40.975 Y20.096 E0.05
+G1 X41.913 Y20.381 E0.05
+G1 X42.778 Y20.843 E0.05
+G1 X43.536 Y21.464 E0.05
+G1 X44.157 Y22.222 E0.05
+G1 X44.619 Y23.087 E0.05
+G1 X44.904 Y24.025 E0.05
+G1 X45.000 Y25.000 E0.05
+G1 X45 Y40 E0.6
+G1 X20 Y40 E1.0
+G1 X20 Y20 E0.8 ; close
+G1 E-1 F2100
+G1 X22 Y22 F6000
+G1 E1 F2100
+G1 Z0.7 F300
+;LAYER:2
+G1 X40 Y20 E0.8 F1800
+G1 X40.975 Y20.096 E0.05
+G1 X41.913 Y20.381 E0.05
+G1 X42.778 Y20.843 E0.05
+G1 X43.536 Y21.464 E0.05
+G1 X44.157 Y22.222 E0.05
+G1 X44.619 Y23.087 E0.05
+G1 X44.904 Y24.025 E0.05
+G1 X45.000 Y25.000 E0.05
+G1 X45 Y40 E0.6
+G1 X20 Y40 E1.0
+G1 X20 Y20 E0.8 ; close
+G1 E-1 F2100
+G1 X22 Y22 F6000
+G1 E1 F2100
+G1 Z5 F300
+M84